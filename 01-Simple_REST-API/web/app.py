@@ -1,158 +1,392 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 from flask_restful import Api, Resource
+import json
+import operator
+import os
+
+import numpy as np
+from expression import compileExpression, ExpressionError
 
 
 app = Flask(__name__)
 api = Api(app)
 
-
-def checkPostedData(postedData, functionName):
-    if (functionName == "add" or functionName == "subtract" or functionName == "multiply"):
-        if "x" not in postedData or "y" not in postedData:
-            return 301 #Missing parameter
-        else:
-            return 200
-    elif (functionName == "division"):
-        if "x" not in postedData or "y" not in postedData:
-            return 301
-        elif int(postedData["y"])==0:
-            return 302
+# Operations of the calculator. Each one is served on its route by the Operation
+# resource, the fields of "required" missing from the posted data give a 301 and
+# the fields of "nonZero" equal to 0 a 302. The functions work on ints and on the
+# NumPy arrays of /batch
+OPERATION_REGISTRY = [
+    {"name": "add", "route": "/add", "schema": {"required": ["x", "y"]}, "function": operator.add},
+    {"name": "subtract", "route": "/subtract", "schema": {"required": ["x", "y"]}, "function": operator.sub},
+    {"name": "multiply", "route": "/multiply", "schema": {"required": ["x", "y"]}, "function": operator.mul},
+    {"name": "division", "route": "/divide", "schema": {"required": ["x", "y"], "nonZero": ["y"]},
+     "function": lambda x, y: (x*1.0)/y}
+]
+
+# Operations of /batch, by their name or the name of their route
+OPERATIONS = {operation["name"]: code for code, operation in enumerate(OPERATION_REGISTRY)}
+OPERATIONS.update({operation["route"].strip("/"): code for code, operation in enumerate(OPERATION_REGISTRY)})
+DIVISION = OPERATIONS["division"]
+
+def jsonResponse(retJson):
+    """
+        Serializes the answer of an operation as jsonify does, in a single json.dumps
+    """
+    return Response(json.dumps(retJson, separators=(",", ":")) + "\n", mimetype="application/json")
+
+# Bodies of the error responses of the operations, serialized once
+ERROR_BODIES = {
+    code: json.dumps({"Message": "An error happened", "Status Code": code}, separators=(",", ":")) + "\n"
+    for code in (301, 302)
+}
+
+# Below SAFE_OPERAND, in absolute value, no operation of two operands overflows
+# an int64. Bigger operands are evaluated one by one with Python ints
+SAFE_OPERAND = 2**31
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 100000))
+
+# /stream evaluates its operations STREAM_CHUNK_SIZE lines at a time
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 1000))
+
+
+def compileValidator(schema):
+    """
+        Builds, once per route, the function that verifies the posted data of an
+        operation. It returns the status code and the tuple of the int() of the required
+        fields, or None. The checks of the schema are written out as the source of one
+        function and compiled, so a request runs no loop over the schema: for
+        {"required": ["x", "y"], "nonZero": ["y"]} it is
+
+            def validate(postedData):
+                if type(postedData) is not dict or 'x' not in postedData or 'y' not in postedData:
+                    return MISSING_PARAMETER
+                value1 = int(postedData['y'])
+                if value1 == 0:
+                    return DIVISION_BY_ZERO
+                value0 = int(postedData['x'])
+                return 200, (value0, value1)
+    """
+    required = list(schema["required"])
+    nonZero = set(schema.get("nonZero", ()))
+    lines = ["def validate(postedData):",
+             "    if type(postedData) is not dict" + "".join(f" or {field!r} not in postedData" for field in required) + ":",
+             "        return MISSING_PARAMETER"]
+    # The nonZero fields are converted first, a 0 gives a 302 whatever the other fields
+    for i in sorted(range(len(required)), key=lambda i: required[i] not in nonZero):
+        lines.append(f"    value{i} = int(postedData[{required[i]!r}])")
+        if required[i] in nonZero:
+            lines += [f"    if value{i} == 0:", "        return DIVISION_BY_ZERO"]
+    values = ", ".join(f"value{i}" for i in range(len(required)))
+    lines.append(f"    return 200, ({values}{',' if len(required) == 1 else ''})")
+
+    namespace = {"MISSING_PARAMETER": (301, None), "DIVISION_BY_ZERO": (302, None)}
+    exec("\n".join(lines), namespace)
+    return namespace["validate"]
+
+def toIntArray(values, n):
+    """
+        Converts the first n x or y values of a batch with int(), like the single operation
+        resources do. Returns the int64 array, the mask of the valid values, missing ones
+        and those int() rejects aren't, and the Python ints too big for the array by index.
+        The array holds a 1 in their place
+    """
+    if len(values) == n:
+        try:
+            array = np.array(values, dtype=np.int64)
+            #A list among the values gives an array of more than one dimension
+            if array.shape == (n,) and np.all(np.abs(array) < SAFE_OPERAND):
+                return array, np.ones(n, dtype=bool), {}
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+    #Some value is missing, invalid or too big, convert them one by one
+    array = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    big = {}
+    for i, value in enumerate(values[:n]):
+        try:
+            value = int(value)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        valid[i] = True
+        if abs(value) < SAFE_OPERAND:
+            array[i] = value
         else:
-            return 200
+            array[i] = 1
+            big[i] = value
+    return array, valid, big
+
+def evaluate(code, x, y):
+    return OPERATION_REGISTRY[code]["function"](x, y)
+
+def evaluateBatch(operations, x, y):
+    """
+        Evaluates operations[i] on x[i] and y[i] for every i with NumPy, one vector
+        operation per kind of operation. Returns the list of results and the list of
+        status codes: 301 for a missing x or y, 302 for a division by zero, 303 for an
+        unknown operation, as the Operation resource does for a single operation, and 306
+        for a division whose operands are too big for a float
+    """
+    n = len(operations)
+    codes = np.array([OPERATIONS.get(operation, -1) if isinstance(operation, str) else -1
+                      for operation in operations], dtype=np.int8)
+    xs, xValid, xBig = toIntArray(x, n)
+    ys, yValid, yBig = toIntArray(y, n)
+
+    status = np.full(n, 200, dtype=np.int32)
+    status[codes < 0] = 303
+    status[(codes >= 0) & ~(xValid & yValid)] = 301
+    isDivision = codes == DIVISION
+    status[isDivision & (ys == 0) & (status == 200)] = 302
+
+    ints = np.zeros(n, dtype=np.int64)
+    for code in range(len(OPERATION_REGISTRY)):
+        if code == DIVISION:
+            continue
+        mask = codes == code
+        ints[mask] = evaluate(code, xs[mask], ys[mask])
+
+    floats = np.zeros(n, dtype=np.float64)
+    divide = isDivision & (status == 200)
+    floats[divide] = evaluate(DIVISION, xs[divide].astype(np.float64), ys[divide])
+
+    ints = ints.tolist()
+    floats = floats.tolist()
+    status = status.tolist()
+    results = [None if code != 200 else floats[i] if division else ints[i]
+               for i, (code, division) in enumerate(zip(status, isDivision.tolist()))]
+
+    #Operations with a big operand are evaluated with Python ints, an item whose result
+    #doesn't fit a float gets a 306 without failing the others
+    for i in set(xBig) | set(yBig):
+        if status[i] == 200:
+            try:
+                results[i] = evaluate(int(codes[i]), xBig.get(i, int(xs[i])), yBig.get(i, int(ys[i])))
+            except OverflowError:
+                results[i] = None
+                status[i] = 306
+
+    return results, status
+
+def evaluateChunk(lines):
+    """
+        Evaluates a chunk of NDJSON lines, each one an object with "operation", "x" and
+        "y", with evaluateBatch. Returns the NDJSON results, one line per operation. A
+        line that isn't a JSON object, or whose x or y isn't a number or a string, gets a
+        301, one whose operation isn't a string a 303 and one too big to evaluate a 306.
+        The results are sent while the stream is read, a line must never make the chunk fail
+    """
+    operations, x, y, malformed = [], [], [], []
+    for i, line in enumerate(lines):
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict):
+            malformed.append(i)
+            item = {}
+        operation = item.get("operation")
+        operations.append(operation if isinstance(operation, str) else None)
+        x.append(item.get("x") if isinstance(item.get("x"), (int, float, str)) else None)
+        y.append(item.get("y") if isinstance(item.get("y"), (int, float, str)) else None)
+
+    results, status = evaluateBatch(operations, x, y)
+    for i in malformed:
+        status[i] = 301
+    return "".join(json.dumps({"Message": result, "Status Code": code}) + "\n"
+                   for result, code in zip(results, status))
+
+def evaluateStream(stream):
+    """
+        Reads NDJSON operations from a stream, one line at a time, and yields the results
+        of every STREAM_CHUNK_SIZE of them as soon as they are evaluated. Only one chunk is
+        kept in memory, whatever the size of the stream
+    """
+    chunk = []
+    for line in stream:
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield evaluateChunk(chunk)
+            chunk = []
+    if chunk:
+        yield evaluateChunk(chunk)
+
+class Operation(Resource):
+    """
+        Resource of every operation of OPERATION_REGISTRY, with the function and the
+        validator of its route
+    """
+    def __init__(self, function, validate):
+        self.function = function
+        self.validate = validate
 
-class Add(Resource):
     def post(self):
-        #If I am here, then the resouce Add was requested using the method POST
+        #If I am here, then the resouce of an operation was requested using the method POST
 
-        #Step 1: Get posted data:
-        postedData = request.get_json()
-
-        #Steb 1b: Verify validity of posted data
-        status_code = checkPostedData(postedData, "add")
+        #Step 1: Get posted data and verify it with the validator of the route
+        status_code, values = self.validate(request.get_json())
         if (status_code!=200):
-            retJson = {
-                "Message": "An error happened",
-                "Status Code":status_code
-            }
-            return jsonify(retJson)
+            return Response(ERROR_BODIES[status_code], mimetype="application/json")
 
-        #If i am here, then status_code == 200
-        x = postedData["x"]
-        y = postedData["y"]
-        x = int(x)
-        y = int(y)
-
-        #Step 2: Add the posted data
-        ret = x+y
+        #Step 2: Apply the operation to the posted data
         retMap = {
-            'Message': ret,
+            'Message': self.function(*values),
             'Status Code': 200
         }
-        return jsonify(retMap)
+        return jsonResponse(retMap)
 
-class Subtract(Resource):
+class Batch(Resource):
     def post(self):
-        #If I am here, then the resouce Subtract was requested using the method POST
+        #If I am here, then the resouce Batch was requested using the method POST
 
         #Step 1: Get posted data:
         postedData = request.get_json()
 
-        #Steb 1b: Verify validity of posted data
-        status_code = checkPostedData(postedData, "subtract")
-
-
-        if (status_code!=200):
+        #Steb 1b: Verify validity of posted data. operations is a list, or the name of
+        #the operation of every item
+        if "operations" not in postedData or "x" not in postedData or "y" not in postedData:
             retJson = {
                 "Message": "An error happened",
-                "Status Code":status_code
+                "Status Code": 301
             }
             return jsonify(retJson)
 
-        #If i am here, then status_code == 200
         x = postedData["x"]
         y = postedData["y"]
-        x = int(x)
-        y = int(y)
+        operations = postedData["operations"]
+        if not isinstance(x, list) or not isinstance(y, list) or not isinstance(operations, (list, str)):
+            retJson = {
+                "Message": "x, y and operations must be lists",
+                "Status Code": 301
+            }
+            return jsonify(retJson)
+        if isinstance(operations, str):
+            operations = [operations] * max(len(x), len(y))
 
-        #Step 2: Subtract the posted data
-        ret = x-y
+        if len(operations) > MAX_BATCH_SIZE:
+            retJson = {
+                "Message": f"A batch can't have more than {MAX_BATCH_SIZE} operations",
+                "Status Code": 304
+            }
+            return jsonify(retJson)
+
+        #Step 2: Evaluate the batch, every item gets its result and its status code
+        results, status = evaluateBatch(operations, x, y)
         retMap = {
-            'Message': ret,
+            'Message': results,
+            'Status Codes': status,
             'Status Code': 200
         }
         return jsonify(retMap)
 
-
-class Multiply(Resource):
+class Eval(Resource):
     def post(self):
-        #If I am here, then the resouce Multiply was requested using the method POST
+        #If I am here, then the resouce Eval was requested using the method POST
 
         #Step 1: Get posted data:
         postedData = request.get_json()
 
-        #Steb 1b: Verify validity of posted data
-        status_code = checkPostedData(postedData, "multiply")
-
-
-        if (status_code!=200):
+        #Steb 1b: Verify validity of posted data. The expression is evaluated with the
+        #object "variables", or once for every object of the list "bindings"
+        if "expression" not in postedData:
             retJson = {
                 "Message": "An error happened",
-                "Status Code":status_code
+                "Status Code": 301
             }
             return jsonify(retJson)
 
-        #If i am here, then status_code == 200
-        x = postedData["x"]
-        y = postedData["y"]
-        x = int(x)
-        y = int(y)
-
-        #Step 2: Multiply the posted data
-        ret = x*y
-        retMap = {
-            'Message': ret,
-            'Status Code': 200
-        }
-        return jsonify(retMap)
-
-class Divide(Resource):
-    def post(self):
-        #If I am here, then the resouce Divide was requested using the method POST
-
-        #Step 1: Get posted data:
-        postedData = request.get_json()
+        bindings = postedData.get("bindings")
+        if bindings is not None and not isinstance(bindings, list):
+            retJson = {
+                "Message": "bindings must be a list",
+                "Status Code": 301
+            }
+            return jsonify(retJson)
+        if bindings is not None and len(bindings) > MAX_BATCH_SIZE:
+            retJson = {
+                "Message": f"A batch can't have more than {MAX_BATCH_SIZE} bindings",
+                "Status Code": 304
+            }
+            return jsonify(retJson)
 
-        #Steb 1b: Verify validity of posted data
-        status_code = checkPostedData(postedData, "division")
+        #Step 2: Compile the expression, or take it from the cache of compiled ones
+        try:
+            expression = compileExpression(str(postedData["expression"]))
+        except ExpressionError as e:
+            retJson = {
+                "Message": str(e),
+                "Status Code": 305
+            }
+            return jsonify(retJson)
 
+        #Step 3: Evaluate every binding at once with NumPy
+        if bindings is not None:
+            results, status = expression.evaluateMany(bindings)
+            retMap = {
+                'Message': results,
+                'Status Codes': status,
+                'Status Code': 200
+            }
+            return jsonify(retMap)
 
-        if (status_code!=200):
+        #Step 3b: Evaluate the expression once
+        try:
+            ret = expression.evaluate(postedData.get("variables", {}))
+        except KeyError as e:
+            retJson = {
+                "Message": f"Missing variable {e.args[0]}",
+                "Status Code": 301
+            }
+            return jsonify(retJson)
+        except TypeError as e:
+            retJson = {
+                "Message": str(e),
+                "Status Code": 301
+            }
+            return jsonify(retJson)
+        except ZeroDivisionError:
             retJson = {
                 "Message": "An error happened",
-                "Status Code":status_code
+                "Status Code": 302
+            }
+            return jsonify(retJson)
+        except OverflowError:
+            retJson = {
+                "Message": "A number is too big to be evaluated",
+                "Status Code": 306
             }
             return jsonify(retJson)
 
-        #If i am here, then status_code == 200
-        x = postedData["x"]
-        y = postedData["y"]
-        x = int(x)
-        y = int(y)
-
-        #Step 2: Multiply the posted data
-        ret = (x*1.0)/y
         retMap = {
             'Message': ret,
             'Status Code': 200
         }
         return jsonify(retMap)
 
+class Stream(Resource):
+    def post(self):
+        #If I am here, then the resouce Stream was requested using the method POST
+
+        #Step 1: Read the operations from the request body while they arrive, one JSON
+        #object per line, instead of loading the whole body with get_json
+        results = evaluateStream(request.stream)
+
+        #Step 2: Send one JSON result per line, in the order of the operations
+        return Response(stream_with_context(results), mimetype="application/x-ndjson")
 
 
-api.add_resource(Add, "/add")
-api.add_resource(Subtract, "/subtract")
-api.add_resource(Multiply, "/multiply")
-api.add_resource(Divide, "/divide")
+for operation in OPERATION_REGISTRY:
+    api.add_resource(Operation, operation["route"], endpoint=operation["route"].strip("/"),
+                     resource_class_kwargs={
+                         "function": operation["function"],
+                         "validate": compileValidator(operation["schema"])
+                     })
+api.add_resource(Batch, "/batch")
+api.add_resource(Stream, "/stream")
+api.add_resource(Eval, "/eval")
 
 @app.route('/')
 def hello_world():
@@ -0,0 +1,65 @@
+"""
+    Operations per second of the calculator API, one POST per operation
+    against the same operations sent through /batch. Both go over one
+    keep-alive connection, so only the per call overhead differs. Start
+    the API with docker-compose up, then:
+
+        docker-compose exec web python bench/batch_throughput.py
+
+    The results of /batch are checked against the single calls
+"""
+
+import argparse
+import http.client
+import json
+import random
+import time
+import urllib.parse
+
+ROUTES = {"add": "/add", "subtract": "/subtract", "multiply": "/multiply", "division": "/divide"}
+
+
+def post(connection, path, body):
+    connection.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+    return json.loads(connection.getresponse().read())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--operations", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="10,100,1000")
+    args = parser.parse_args()
+
+    url = urllib.parse.urlsplit(args.url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+
+    rng = random.Random(0)
+    operations = [rng.choice(list(ROUTES)) for _ in range(args.operations)]
+    x = [rng.randint(-1000, 1000) for _ in range(args.operations)]
+    y = [rng.randint(1, 1000) for _ in range(args.operations)]
+
+    start = time.monotonic()
+    single = [post(connection, ROUTES[operation], {"x": a, "y": b})["Message"]
+              for operation, a, b in zip(operations, x, y)]
+    singleRate = args.operations / (time.monotonic() - start)
+
+    print(f"{'mode':<20}{'ops/s':>12}{'speedup':>10}")
+    print(f"{'one call per op':<20}{singleRate:>12.1f}{1:>9.1f}x")
+    for size in [int(value) for value in args.batch_sizes.split(",")]:
+        start = time.monotonic()
+        results = []
+        for first in range(0, args.operations, size):
+            retJson = post(connection, "/batch", {
+                "operations": operations[first:first + size],
+                "x": x[first:first + size],
+                "y": y[first:first + size]
+            })
+            results.extend(retJson["Message"])
+        rate = args.operations / (time.monotonic() - start)
+        if results != single:
+            raise SystemExit(f"/batch of {size} gave other results than the single calls")
+        print(f"{f'/batch of {size}':<20}{rate:>12.1f}{rate / singleRate:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
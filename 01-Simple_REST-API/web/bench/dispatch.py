@@ -0,0 +1,153 @@
+"""
+    In-process microbenchmark of the operation routes: the registry driven
+    Operation resource of app.py against a copy of the Add and Divide
+    resources the API had before, with checkPostedData and jsonify:
+
+        docker-compose exec web python bench/dispatch.py
+
+    Three levels are timed: whole requests through the Flask test client,
+    the post() of the resources alone in a request whose JSON is already
+    parsed, which is the dispatch path, and the validation alone
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from flask import Flask, jsonify, request
+from flask_restful import Api, Resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as registry
+
+
+def checkPostedData(postedData, functionName):
+    if (functionName == "add" or functionName == "subtract" or functionName == "multiply"):
+        if "x" not in postedData or "y" not in postedData:
+            return 301 #Missing parameter
+        else:
+            return 200
+    elif (functionName == "division"):
+        if "x" not in postedData or "y" not in postedData:
+            return 301
+        elif int(postedData["y"])==0:
+            return 302
+        else:
+            return 200
+
+class Add(Resource):
+    def post(self):
+        postedData = request.get_json()
+
+        status_code = checkPostedData(postedData, "add")
+        if (status_code!=200):
+            retJson = {
+                "Message": "An error happened",
+                "Status Code":status_code
+            }
+            return jsonify(retJson)
+
+        x = postedData["x"]
+        y = postedData["y"]
+        x = int(x)
+        y = int(y)
+
+        ret = x+y
+        retMap = {
+            'Message': ret,
+            'Status Code': 200
+        }
+        return jsonify(retMap)
+
+class Divide(Resource):
+    def post(self):
+        postedData = request.get_json()
+
+        status_code = checkPostedData(postedData, "division")
+        if (status_code!=200):
+            retJson = {
+                "Message": "An error happened",
+                "Status Code":status_code
+            }
+            return jsonify(retJson)
+
+        x = postedData["x"]
+        y = postedData["y"]
+        x = int(x)
+        y = int(y)
+
+        ret = (x*1.0)/y
+        retMap = {
+            'Message': ret,
+            'Status Code': 200
+        }
+        return jsonify(retMap)
+
+def legacyApp():
+    legacy = Flask("legacy")
+    api = Api(legacy)
+    api.add_resource(Add, "/add")
+    api.add_resource(Divide, "/divide")
+    return legacy
+
+def rate(function, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return calls / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    clients = {"legacy": legacyApp().test_client(), "registry": registry.app.test_client()}
+    cases = [
+        ("/add", {"x": 12, "y": 30}),
+        ("/divide", {"x": 12, "y": 3}),
+        ("/divide", {"x": 12, "y": 0}),
+        ("/add", {"x": 12}),
+    ]
+
+    print(f"{'request':<36}{'legacy/s':>12}{'registry/s':>12}{'speedup':>10}")
+    for path, body in cases:
+        rates = {}
+        for name, client in clients.items():
+            responses = {client.post(path, json=body).get_json()["Status Code"] for _ in range(2)}
+            if len(responses) != 1:
+                raise SystemExit(f"{name} {path} answers differently")
+            rates[name] = rate(lambda: client.post(path, json=body), args.calls)
+        case = f"{path} {body}"
+        print(f"{case:<36}{rates['legacy']:>12.0f}{rates['registry']:>12.0f}{rates['registry'] / rates['legacy']:>9.2f}x")
+
+    legacy = legacyApp()
+    resources = {"/add": Add(), "/divide": Divide()}
+    for path, body in cases:
+        operation = next(operation for operation in registry.OPERATION_REGISTRY if operation["route"] == path)
+        resource = registry.Operation(operation["function"], registry.compileValidator(operation["schema"]))
+        with legacy.test_request_context(path, method="POST", json=body):
+            legacyRate = rate(resources[path].post, args.calls * 5)
+        with registry.app.test_request_context(path, method="POST", json=body):
+            registryRate = rate(resource.post, args.calls * 5)
+        case = f"post() {path} {body}"
+        print(f"{case:<36}{legacyRate:>12.0f}{registryRate:>12.0f}{registryRate / legacyRate:>9.2f}x")
+
+    validate = registry.compileValidator({"required": ["x", "y"], "nonZero": ["y"]})
+    body = {"x": 12, "y": 3}
+
+    def legacyValidation():
+        if checkPostedData(body, "division") == 200:
+            return int(body["x"]), int(body["y"])
+
+    def registryValidation():
+        return validate(body)[1]
+
+    legacyRate = rate(legacyValidation, args.calls * 10)
+    registryRate = rate(registryValidation, args.calls * 10)
+    print(f"{'validation only':<36}{legacyRate:>12.0f}{registryRate:>12.0f}{registryRate / legacyRate:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+    Arithmetic expressions of the /eval resource. Expressions are parsed
+    without eval and compiled to Python closures that evaluate them either
+    for one set of variables or, with NumPy, for many at once
+"""
+
+import functools
+import math
+import os
+import re
+
+import numpy as np
+
+EXPRESSION_CACHE_SIZE = int(os.environ.get("EXPRESSION_CACHE_SIZE", 1024))
+MAX_EXPRESSION_LENGTH = int(os.environ.get("MAX_EXPRESSION_LENGTH", 1000))
+MAX_EXPRESSION_DEPTH = 100
+
+# Integer results are exact in a float64 below 2**53, the vectorized integer
+# evaluation is trusted for the rows that stay below it
+EXACT_FLOAT = 2**53
+
+# Variables and constants from INT64_LIMIT up, in absolute value, don't fit an int64
+INT64_LIMIT = 2**63
+
+TOKENS = re.compile(r"\s*(?:(\d+\.\d*|\.\d+|\d+)|([A-Za-z_]\w*)|(\S))")
+
+
+class ExpressionError(ValueError):
+    """
+        Raised for an expression that can't be parsed
+    """
+
+
+class Run:
+    """
+        State of one evaluation: the rows divided by zero and, when track is on,
+        the largest absolute value seen by each row
+    """
+    def __init__(self, track=False):
+        self.track = track
+        self.zero = None
+        self.peak = 0
+
+    def observe(self, value):
+        if self.track:
+            self.peak = np.maximum(self.peak, np.abs(value))
+        return value
+
+    def divisor(self, value):
+        """
+            Raise ZeroDivisionError for a scalar 0. For an array, the rows with a 0 are
+            remembered and divided by 1 instead, their result is discarded
+        """
+        if not isinstance(value, np.ndarray):
+            if value == 0:
+                raise ZeroDivisionError()
+            return value
+        zero = value == 0
+        self.zero = zero if self.zero is None else self.zero | zero
+        return np.where(zero, 1, value)
+
+
+def compileNode(node):
+    """
+        Returns the closure that evaluates a node of the tree with the values of the
+        variables and a Run
+    """
+    kind = node[0]
+    if kind == "number":
+        value = node[1]
+        return lambda variables, run: value
+    if kind == "variable":
+        name = node[1]
+        return lambda variables, run: run.observe(variables[name])
+    if kind == "negative":
+        operand = compileNode(node[1])
+        return lambda variables, run: -operand(variables, run)
+
+    left = compileNode(node[1])
+    right = compileNode(node[2])
+    if kind == "+":
+        return lambda variables, run: run.observe(left(variables, run) + right(variables, run))
+    if kind == "-":
+        return lambda variables, run: run.observe(left(variables, run) - right(variables, run))
+    if kind == "*":
+        return lambda variables, run: run.observe(left(variables, run) * right(variables, run))
+    # The single operation Divide resource returns (x*1.0)/y
+    return lambda variables, run: run.observe((left(variables, run) * 1.0) / run.divisor(right(variables, run)))
+
+
+class Parser:
+    """
+        Recursive descent parser of +, -, *, /, unary minus, parentheses, numbers
+        and variables, with the usual precedence. Builds a tree of tuples
+    """
+    def __init__(self, text):
+        self.tokens = []
+        for number, name, symbol in TOKENS.findall(text):
+            if symbol and symbol not in "+-*/()":
+                raise ExpressionError(f"Unexpected character {symbol}")
+            self.tokens.append((number, name, symbol))
+        self.position = 0
+        self.depth = 0
+        self.variables = set()
+        self.hasDivision = False
+        self.largestInteger = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, symbol):
+        token = self.peek()
+        if token is not None and token[2] == symbol:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        tree = self.sum()
+        if self.peek() is not None:
+            raise ExpressionError("Unexpected input after the end of the expression")
+        return tree
+
+    def sum(self):
+        node = self.product()
+        while True:
+            if self.take("+"):
+                node = ("+", node, self.product())
+            elif self.take("-"):
+                node = ("-", node, self.product())
+            else:
+                return node
+
+    def product(self):
+        node = self.unary()
+        while True:
+            if self.take("*"):
+                node = ("*", node, self.unary())
+            elif self.take("/"):
+                self.hasDivision = True
+                node = ("/", node, self.unary())
+            else:
+                return node
+
+    def unary(self):
+        # A run of signs is read in a loop, not one recursive call per sign, and
+        # only its parity matters: --x is x
+        negative = False
+        while True:
+            if self.take("-"):
+                negative = not negative
+            elif not self.take("+"):
+                break
+        node = self.atom()
+        return ("negative", node) if negative else node
+
+    def atom(self):
+        token = self.peek()
+        if token is None:
+            raise ExpressionError("Unexpected end of the expression")
+        number, name, symbol = token
+
+        if symbol == "(":
+            self.position += 1
+            self.depth += 1
+            if self.depth > MAX_EXPRESSION_DEPTH:
+                raise ExpressionError(f"More than {MAX_EXPRESSION_DEPTH} nested parentheses")
+            node = self.sum()
+            if not self.take(")"):
+                raise ExpressionError("Missing closing parenthesis")
+            self.depth -= 1
+            return node
+
+        self.position += 1
+        if number:
+            if "." in number:
+                return ("number", float(number))
+            self.largestInteger = max(self.largestInteger, int(number))
+            return ("number", int(number))
+        if name:
+            self.variables.add(name)
+            return ("variable", name)
+        raise ExpressionError(f"Unexpected {symbol}")
+
+
+class Expression:
+    """
+        A parsed and compiled expression. Integer variables give exact integer
+        results and any division gives a float, as the single operation
+        resources do. evaluateMany uses floats for every binding when a
+        variable is a float in any of them
+    """
+    def __init__(self, text):
+        if len(text) > MAX_EXPRESSION_LENGTH:
+            raise ExpressionError(f"An expression can't be longer than {MAX_EXPRESSION_LENGTH} characters")
+        parser = Parser(text)
+        self.tree = parser.parse()
+        self.variables = parser.variables
+        self.hasDivision = parser.hasDivision
+        self.hasFloats = "." in text
+        # An int64 array combined with a constant outside int64 raises OverflowError
+        self.hasBigIntegers = parser.largestInteger >= INT64_LIMIT
+        self.function = compileNode(self.tree)
+
+    def evaluate(self, variables):
+        """
+            Evaluates the expression with Python numbers. Raise KeyError for a missing
+            variable, TypeError for one that isn't a finite number, ZeroDivisionError for a
+            division by zero and OverflowError for an integer too big for a float or a
+            result that isn't finite
+        """
+        for name in self.variables:
+            value = variables[name]
+            if not isinstance(value, (int, float)) or (isinstance(value, float) and not math.isfinite(value)):
+                raise TypeError(f"Variable {name} must be a finite number")
+        ret = self.function({name: variables[name] for name in self.variables}, Run())
+        if isinstance(ret, float) and not math.isfinite(ret):
+            raise OverflowError("The result is not a finite number")
+        return ret
+
+    def evaluateMany(self, bindings):
+        """
+            Evaluates the expression for every object of variables in bindings with NumPy.
+            Returns the list of results and the list of status codes: 301 for a missing or
+            non numeric variable, 302 for a division by zero and 306 for a constant too big
+            for a float or a result that isn't finite
+        """
+        n = len(bindings)
+        valid = np.ones(n, dtype=bool)
+        columns = {}
+        for name in self.variables:
+            values = [binding.get(name) if isinstance(binding, dict) else None for binding in bindings]
+            # Ints must fit an int64 column, floats only need to be finite
+            isNumber = np.array([isinstance(value, float) and math.isfinite(value) or
+                                 isinstance(value, int) and abs(value) < INT64_LIMIT for value in values], dtype=bool)
+            valid &= isNumber
+            columns[name] = np.array([value if ok else 0 for value, ok in zip(values, isNumber)])
+
+        integer = not self.hasDivision and not self.hasFloats and all(
+            column.dtype.kind in "iub" for column in columns.values())
+
+        overflow = False
+        if integer and self.hasBigIntegers:
+            # Every row is evaluated with Python ints
+            exact = np.zeros(n, dtype=bool)
+            run = Run()
+            values = None
+        elif integer:
+            # Find the rows an int64 evaluation is exact for, then evaluate them
+            floatRun = Run(track=True)
+            self.function({name: column.astype(np.float64) for name, column in columns.items()}, floatRun)
+            exact = np.broadcast_to(floatRun.peak < EXACT_FLOAT, (n,))
+            run = Run()
+            values = self.function({name: column.astype(np.int64) for name, column in columns.items()}, run)
+        else:
+            exact = np.ones(n, dtype=bool)
+            run = Run()
+            try:
+                values = self.function({name: column.astype(np.float64) for name, column in columns.items()}, run)
+            except ZeroDivisionError:
+                # A constant divisor is 0 for every row
+                values = None
+                run.zero = True
+            except OverflowError:
+                # A constant is too big for a float, in every row
+                values = None
+                overflow = True
+
+        values = np.broadcast_to(values, (n,))
+        status = np.full(n, 200, dtype=np.int32)
+        if run.zero is not None:
+            status[np.broadcast_to(run.zero, (n,))] = 302
+        if values.dtype.kind == "f":
+            # Infinity and NaN aren't valid JSON, a float result that overflowed gets a 306
+            status[~np.isfinite(values)] = 306
+        if overflow:
+            status[:] = 306
+        values = values.tolist()
+        status[~valid] = 301
+        status = status.tolist()
+
+        results = [value if code == 200 else None for value, code in zip(values, status)]
+
+        # Rows whose integers grow too big are evaluated one by one with Python ints
+        for i in np.flatnonzero(~exact).tolist():
+            if status[i] == 200:
+                try:
+                    results[i] = self.evaluate(bindings[i])
+                except OverflowError:
+                    results[i] = None
+                    status[i] = 306
+        return results, status
+
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compileExpression(text):
+    """
+        Returns the Expression of a text. The last EXPRESSION_CACHE_SIZE expressions
+        are kept compiled. Raise ExpressionError if the text isn't a valid expression
+    """
+    return Expression(text)
@@ -0,0 +1,46 @@
+"""
+    Tests of the /batch resource. Run them from the web directory:
+
+        python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def batch(self, operations, x, y):
+        return self.client.post("/batch", json={"operations": operations, "x": x, "y": y}).get_json()
+
+    def test_mixed_operations(self):
+        retJson = self.batch(["add", "subtract", "multiply", "divide"], [6, 6, 6, 6], [3, 3, 3, 3])
+        self.assertEqual(retJson["Status Code"], 200)
+        self.assertEqual(retJson["Message"], [9, 3, 18, 2.0])
+        self.assertEqual(retJson["Status Codes"], [200, 200, 200, 200])
+
+    def test_item_errors(self):
+        retJson = self.batch(["add", "divide", "modulo"], [1, 1, 1], [None, 0, 1])
+        self.assertEqual(retJson["Status Codes"], [301, 302, 303])
+
+    def test_huge_operand_division_fails_only_its_item(self):
+        huge = "1" * 400
+        retJson = self.batch(["divide", "add", "multiply"], [huge, huge, 2], [3, 1, 3])
+        self.assertEqual(retJson["Status Code"], 200)
+        self.assertEqual(retJson["Status Codes"], [306, 200, 200])
+        self.assertEqual(retJson["Message"], [None, int(huge) + 1, 6])
+
+    def test_operands_must_be_lists(self):
+        retJson = self.client.post("/batch", json={"operations": "add", "x": 1, "y": 2}).get_json()
+        self.assertEqual(retJson["Status Code"], 301)
+
+
+if __name__ == "__main__":
+    unittest.main()
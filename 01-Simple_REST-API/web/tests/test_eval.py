@@ -0,0 +1,50 @@
+"""
+    Tests of the /eval resource. Run them from the web directory:
+
+        python -m unittest discover tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class EvalTest(unittest.TestCase):
+    def eval(self, body):
+        # json.dumps writes NaN and Infinity as the Python json module reads them
+        response = app.app.test_client().post("/eval", data=json.dumps(body), content_type="application/json")
+        return json.loads(response.get_data(as_text=True), parse_constant=self.fail)
+
+    def test_variables(self):
+        retJson = self.eval({"expression": "x * (y - 1)", "variables": {"x": 3, "y": 5}})
+        self.assertEqual(retJson, {"Message": 12, "Status Code": 200})
+
+    def test_bindings(self):
+        retJson = self.eval({"expression": "x / y", "bindings": [{"x": 1, "y": 2}, {"x": 1, "y": 0}, {"x": 1}]})
+        self.assertEqual(retJson["Message"], [0.5, None, None])
+        self.assertEqual(retJson["Status Codes"], [200, 302, 301])
+
+    def test_bindings_must_be_a_list(self):
+        retJson = self.eval({"expression": "x + 1", "bindings": 5})
+        self.assertEqual(retJson["Status Code"], 301)
+
+    def test_float_overflow_is_306(self):
+        # 1e308 written out, the parser reads no exponent
+        self.assertEqual(self.eval({"expression": "1" + "0" * 308 + ".0 * 10"})["Status Code"], 306)
+        retJson = self.eval({"expression": "x*10", "bindings": [{"x": 1e308}, {"x": 1.5}]})
+        self.assertEqual(retJson["Message"], [None, 15.0])
+        self.assertEqual(retJson["Status Codes"], [306, 200])
+
+    def test_non_finite_variables_are_rejected(self):
+        self.assertEqual(self.eval({"expression": "x + 1", "variables": {"x": float("nan")}})["Status Code"], 301)
+        retJson = self.eval({"expression": "x + 1", "bindings": [{"x": float("nan")}, {"x": float("inf")}, {"x": 1}]})
+        self.assertEqual(retJson["Status Codes"], [301, 301, 200])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+    Tests of the /stream resource. Run them from the web directory:
+
+        python -m unittest discover tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class StreamTest(unittest.TestCase):
+    def stream(self, lines):
+        response = app.app.test_client().post("/stream", data="".join(line + "\n" for line in lines))
+        return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_one_result_per_line(self):
+        results = self.stream([
+            json.dumps({"operation": "add", "x": 1, "y": 2}),
+            json.dumps({"operation": "divide", "x": 1, "y": 0}),
+            "not json",
+            json.dumps({"operation": 5, "x": 1, "y": 2})
+        ])
+        self.assertEqual([result["Status Code"] for result in results], [200, 302, 301, 303])
+        self.assertEqual(results[0]["Message"], 3)
+
+    def test_huge_operand_division_does_not_cut_the_stream(self):
+        results = self.stream([
+            json.dumps({"operation": "divide", "x": "1" * 400, "y": 3}),
+            json.dumps({"operation": "multiply", "x": 4, "y": 3})
+        ])
+        self.assertEqual(results, [
+            {"Message": None, "Status Code": 306},
+            {"Message": 12, "Status Code": 200}
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
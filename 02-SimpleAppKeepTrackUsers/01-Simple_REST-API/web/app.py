@@ -1,8 +1,10 @@
 from flask import Flask, jsonify, request
 from flask_restful import Api, Resource
+import atexit
 import os
 
 from pymongo import MongoClient
+from counter import Counter, RangeCounter
 
 app = Flask(__name__)
 api = Api(app)
@@ -16,16 +18,20 @@ db = client.aNewDB
 # Step 2: create a collection named UserNum
 UserNum = db["UserNum"]
 
-# Step 3: insert a document to keep track of the numbers of user who visits the website
-UserNum.insert({
-    'num_of_users':0
-})
+# Step 3: keep track of the numbers of user who visits the website in one document.
+# With VISIT_BLOCK_SIZE > 0 every worker reserves that many numbers at once and
+# counts its visits every VISIT_FLUSH_SECONDS
+visitCounter = Counter(UserNum)
+if int(os.environ.get("VISIT_BLOCK_SIZE", 0)) > 0:
+    visitCounter = RangeCounter(visitCounter,
+                                blockSize=int(os.environ.get("VISIT_BLOCK_SIZE")),
+                                flushSeconds=float(os.environ.get("VISIT_FLUSH_SECONDS", 5)))
+visitCounter.setUp()
+atexit.register(visitCounter.flush)
 
 class Visit(Resource):
     def get(self):
-        prev_num = UserNum.find({})[0]['num_of_users']
-        new_num = prev_num + 1
-        UserNum.update({}, {"$set":{"num_of_users":new_num}})
+        new_num = visitCounter.next()
         return f"Hello user {new_num}"
 
 
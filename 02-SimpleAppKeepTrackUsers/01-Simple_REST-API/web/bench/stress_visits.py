@@ -0,0 +1,57 @@
+"""
+    Concurrent visit counter stress test. Sends many GET /hello from many
+    clients at once and checks that no visitor number was given twice.
+    Start the API with docker-compose up, then:
+
+        docker-compose exec web python bench/stress_visits.py
+
+    With the atomic counter the numbers must also follow each other without
+    gaps, that's exact only if nothing else visits the API meanwhile. With
+    VISIT_BLOCK_SIZE set, workers hand out their blocks side by side and the
+    end of a block can be skipped, run it with --allow-gaps
+"""
+
+import argparse
+import json
+import re
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def visit(base):
+    """
+        Returns the visitor number given by /hello
+    """
+    with urllib.request.urlopen(base + "/hello", timeout=60) as response:
+        return int(re.search(r"Hello user (\d+)", json.loads(response.read())).group(1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--visits", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--allow-gaps", action="store_true")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        numbers = list(executor.map(lambda n: visit(args.url), range(args.visits)))
+    seconds = time.monotonic() - start
+
+    duplicates = sum(count - 1 for count in Counter(numbers).values())
+    gaps = max(numbers) - min(numbers) + 1 - len(set(numbers))
+    print(f"visits               {args.visits} from {args.clients} clients")
+    print(f"numbers              {min(numbers)} to {max(numbers)}")
+    print(f"duplicates           {duplicates}")
+    print(f"gaps                 {gaps}")
+    print(f"visits/second        {args.visits / seconds:.1f}")
+
+    ok = duplicates == 0 and (args.allow_gaps or gaps == 0)
+    print("no lost updates" if ok else "LOST UPDATES")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+    Visitor counter kept in one document of a MongoDB collection
+"""
+
+import threading
+import time
+
+from pymongo import DESCENDING, ReturnDocument
+
+
+class Counter:
+    """
+        Gives every visitor a unique number. The counter document has two fields:
+        num_of_users, the last number given or reserved, and visits, the number
+        of visits. Both change with atomic $inc updates, so no visit is lost or
+        numbered twice whatever the number of workers
+    """
+    def __init__(self, collection, name="visits"):
+        self.collection = collection
+        self.name = name
+
+    def setUp(self):
+        """
+            Creates the counter document if it's missing. Older versions of the API
+            inserted a new document at every start, the count goes on from the
+            highest of them
+        """
+        last = self.collection.find_one({"_id": {"$ne": self.name}}, sort=[("num_of_users", DESCENDING)])
+        start = last["num_of_users"] if last else 0
+        self.collection.update_one(
+            {"_id": self.name},
+            {"$setOnInsert": {"num_of_users": start, "visits": start}},
+            upsert=True
+        )
+
+    def increment(self, numbers, visits):
+        """
+            Adds numbers to num_of_users and visits to visits in one update. Return
+            the new num_of_users
+        """
+        counter = self.collection.find_one_and_update(
+            {"_id": self.name},
+            {"$inc": {"num_of_users": numbers, "visits": visits}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["num_of_users"]
+
+    def next(self):
+        """
+            Returns the number of a new visitor, one round trip per visit
+        """
+        return self.increment(1, 1)
+
+    def flush(self):
+        pass
+
+
+class RangeCounter:
+    """
+        High throughput mode of Counter. A worker reserves blockSize numbers with
+        one update and hands them out from memory, its visits are added to the
+        counter every flushSeconds. Numbers are unique and grow within a worker,
+        but workers hand out their blocks side by side, and the numbers left in
+        a block when a worker stops are never used
+    """
+    def __init__(self, counter, blockSize=100, flushSeconds=5):
+        self.counter = counter
+        self.blockSize = blockSize
+        self.flushSeconds = flushSeconds
+        self.lock = threading.Lock()
+        self.nextNumber = 1
+        self.lastNumber = 0
+        self.unflushed = 0
+        self.lastFlush = time.monotonic()
+
+    def setUp(self):
+        self.counter.setUp()
+
+    def next(self):
+        """
+            Returns the number of a new visitor, from the block reserved by this worker
+        """
+        with self.lock:
+            if self.nextNumber > self.lastNumber:
+                self.lastNumber = self.counter.increment(self.blockSize, 0)
+                self.nextNumber = self.lastNumber - self.blockSize + 1
+
+            number = self.nextNumber
+            self.nextNumber += 1
+            self.unflushed += 1
+
+            if time.monotonic() - self.lastFlush > self.flushSeconds:
+                self.flushLocked()
+            return number
+
+    def flushLocked(self):
+        if self.unflushed:
+            self.counter.increment(0, self.unflushed)
+            self.unflushed = 0
+        self.lastFlush = time.monotonic()
+
+    def flush(self):
+        """
+            Adds the visits not yet counted to the counter document
+        """
+        with self.lock:
+            self.flushLocked()
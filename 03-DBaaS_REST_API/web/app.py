@@ -9,7 +9,9 @@ Retrieve a sentence from our database cost 1 token
 from flask import Flask, jsonify, request
 from flask_restful import Api, Resource
 from pymongo import MongoClient
-import bcrypt
+from pymongo.errors import DuplicateKeyError
+from auth import checkPassword, hashPassword, SessionTokens, bearerToken, cryptoExecutor
+from token_ledger import TokenLedger
 
 app = Flask(__name__)
 api = Api(app)
@@ -25,6 +27,26 @@ db = client.SentencesDatabase
 # Collection of users who stores sentences
 users = db["Users"]
 
+# Tokens are charged and refilled with atomic updates
+tokenLedger = TokenLedger(users)
+
+# Signed session tokens, revoked ones are tracked in RevokedTokens
+sessions = SessionTokens(db["RevokedTokens"])
+
+# Start the bcrypt worker processes before the web server starts its threads
+cryptoExecutor.warmUp()
+
+def createIndexes():
+    """
+        Creates the indexes the queries of the API need. create_index does nothing when
+        the index already exists, so every worker runs it at start
+    """
+    # Every query looks users up by Username, unique so /register can't create duplicates
+    users.create_index("Username", unique=True)
+    sessions.createIndexes()
+
+createIndexes()
+
 class Register(Resource):
     """
         Class for support registration
@@ -40,17 +62,25 @@ class Register(Resource):
         username = postedData["username"]
         password = postedData["password"]
 
-        # Step 3: Hash the password with bcrypt
-        hashed_pw = bcrypt.hashpw(password.encode('utf8'),bcrypt.gensalt())
+        # Step 3: Hash the password with bcrypt, on the crypto pool
+        hashed_pw = hashPassword(password)
 
         # Step 4: Store the username and password into the DB
-        users.insert({
-            "Username": username,
-            "Password": hashed_pw,
-            "Sentence": "",
-            "Tokens": 6
+        # The unique index on Username rejects a user that already exists
+        try:
+            users.insert_one({
+                "Username": username,
+                "Password": hashed_pw,
+                "Sentence": "",
+                "Tokens": 6
 
-        })
+            })
+        except DuplicateKeyError:
+            retJson = {
+                "status": 303,
+                "msg": f"Invalid username. User {username} already exists"
+            }
+            return jsonify(retJson)
 
         # Step 5: Return message to the user
         retJson = {
@@ -60,23 +90,87 @@ class Register(Resource):
 
         return jsonify(retJson)
 
+def verifyPassword(username,password):
+    """
+        Auxiliar function to verify the username and password, ignoring any bearer
+        token. Return True or False, False for a user that doesn't exist
+    """
+    if password is None:
+        return False
+
+    user = users.find_one({"Username": username}, {"Password": 1})
+    if user is None:
+        return False
+
+    return checkPassword(username, password, user["Password"])
+
 def verifyPw(username,password):
     """
-        Auxiliar function to verify the username and password. Return True or False
+        Auxiliar function to verify the username and password. Return True or False.
+        A bearer token in the request replaces the password
     """
-    hashed_pw = users.find({"Username": username})[0]["Password"]
+    token = bearerToken()
+    if token is not None:
+        return sessions.verify(token) == username
 
-    if bcrypt.hashpw(password.encode('utf8'),hashed_pw) == hashed_pw:
-        return True
-    
-    return False
+    return verifyPassword(username, password)
 
-def getTokens(username):
+class Login(Resource):
     """
-        Auxiliar function returns number of tokens a username have
+        Class to open a session
     """
-    tokens = users.find({"Username": username})[0]["Tokens"]
-    return tokens
+    def post(self):
+        """
+            POST Function that exchanges the username and password for a bearer token.
+            The other resources accept the header "Authorization: Bearer <token>"
+            instead of the password until the token expires
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData["password"]
+
+        # Step 3: Verify the username and password match. A token can't open a
+        # new session, the password is always required
+        correct_pw = verifyPassword(username, password)
+        if not correct_pw:
+            retJson = {
+                "status": 302,
+                "msg": "Invalid username or password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Issue the token
+        retJson = {
+            "status": 200,
+            "token": sessions.issue(username),
+            "expiresIn": sessions.ttl
+        }
+        return jsonify(retJson)
+
+class Logout(Resource):
+    """
+        Class to close a session
+    """
+    def post(self):
+        """
+            POST Function that revokes the bearer token of the request
+        """
+        token = bearerToken()
+        if token is None or not sessions.revoke(token):
+            retJson = {
+                "status": 302,
+                "msg": "Invalid session token"
+            }
+            return jsonify(retJson)
+
+        retJson = {
+            "status": 200,
+            "msg": "Session closed"
+        }
+        return jsonify(retJson)
 
 class Store(Resource):
     """
@@ -91,7 +185,7 @@ class Store(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         sentence = postedData["sentence"]
 
         # Step 3: Verify the username and password match
@@ -102,24 +196,15 @@ class Store(Resource):
             }
             return jsonify(retJson)       
 
-        # Step 4: Verify user has enough tokens
-        tokens = getTokens(username)
-        if tokens <= 0:
+        # Step 4: Take one token away and store the sentence in the same atomic
+        # update, nothing is written if the user has no tokens left
+        if tokenLedger.charge(username, setFields={"Sentence": sentence}) is None:
             retJson = {
                 "status": 301
             }
             return jsonify(retJson)
 
-        # Step 5: Store the sentence, take one token away and return 200 OK
-        SELECTION_CRITERIA = {
-            "Username": username
-        }
-        UPDATED_DATA = {
-            "Sentence": sentence,
-            "Tokens": tokens - 1
-        }
-        users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
-
+        # Step 5: Return 200 OK
         retJson = {
             "status": 200,
             "message": "Sentence saved succesfully"
@@ -139,7 +224,7 @@ class GetSentence(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
 
         # Step 3: Verify the username and password match
         correct_pw = verifyPw(username, password)
@@ -149,32 +234,25 @@ class GetSentence(Resource):
             }
             return jsonify(retJson)       
 
-        # Step 4: Verify user has enough tokens
-        tokens = getTokens(username)
-        if tokens <= 0:
+        # Step 4: Take one token away and read the sentence in the same atomic
+        # update, nothing is charged if the user has no tokens left
+        user = tokenLedger.charge(username, projection={"Sentence": 1})
+        if user is None:
             retJson = {
                 "status": 301
             }
             return jsonify(retJson)
 
-        # Step 5: Take one token away, retrieve the sentence and return 200 OK
-        SELECTION_CRITERIA = {
-            "Username": username
-        }
-        UPDATED_DATA = {
-            "Tokens": tokens - 1
-        }
-        users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
-
-        sentence = users.find(SELECTION_CRITERIA)[0]["Sentence"]
-
+        # Step 5: Return the sentence and 200 OK
         retJson = {
             "status": 200,
-            "message": sentence
+            "message": user["Sentence"]
         }
         return jsonify(retJson)       
 
 api.add_resource(Register,'/register')
+api.add_resource(Login,'/login')
+api.add_resource(Logout,'/logout')
 api.add_resource(Store,'/store')
 api.add_resource(GetSentence,'/getSentence')
 
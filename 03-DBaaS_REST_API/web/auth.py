@@ -0,0 +1,326 @@
+"""
+    Authentication helpers shared by the resources of the API: password
+    verification and signed session tokens
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import request
+from werkzeug.exceptions import ServiceUnavailable
+
+# Every worker must share the same TOKEN_SECRET for tokens to be accepted by
+# all of them, without it each process signs with its own random key
+TOKEN_SECRET = os.environ.get("TOKEN_SECRET", "").encode('utf8') or os.urandom(32)
+TOKEN_TTL = int(os.environ.get("TOKEN_TTL", 3600))
+REVOCATION_SYNC_SECONDS = int(os.environ.get("REVOCATION_SYNC_SECONDS", 30))
+
+# bcrypt runs in CRYPTO_WORKERS processes, at most CRYPTO_QUEUE_SIZE more calls
+# may wait for a free worker before new ones are rejected
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", os.cpu_count() or 1))
+CRYPTO_QUEUE_SIZE = int(os.environ.get("CRYPTO_QUEUE_SIZE", 64))
+
+
+class CryptoBusy(ServiceUnavailable):
+    """
+        Raised when the bcrypt queue is full. flask_restful turns it into an
+        HTTP 503 answer with the usual status/msg body
+    """
+    def __init__(self):
+        super().__init__("Too many password operations in progress, please retry")
+        self.data = {
+            "status": 503,
+            "msg": self.description
+        }
+
+
+def hashInWorker(password, salt):
+    return bcrypt.hashpw(password, salt)
+
+
+def noop():
+    return None
+
+
+class CryptoExecutor:
+    """
+        Bounded process pool for bcrypt. bcrypt is CPU bound and deliberately
+        slow, running it here keeps signup and login bursts from stalling the
+        cheap requests served by the same worker. When every worker is busy
+        and the queue is full, calls fail right away with CryptoBusy
+    """
+    def __init__(self, workers=CRYPTO_WORKERS, queueSize=CRYPTO_QUEUE_SIZE):
+        self.workers = workers
+        # Forked workers don't import the app again, under spawn or forkserver
+        # (the default of recent Pythons) each one would re-run app.py and its warmUp.
+        # Before Python 3.7 the pool always forks and takes no context
+        if sys.version_info >= (3, 7):
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queueSize)
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.metrics = {}
+
+    def warmUp(self):
+        """
+            Starts every worker process now, while the web process has no
+            other threads, instead of forking them under load
+        """
+        for future in [self.pool.submit(noop) for _ in range(self.workers)]:
+            future.result()
+
+    def run(self, operation, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise CryptoBusy()
+
+        start = time.monotonic()
+        try:
+            return self.pool.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+            elapsed = (time.monotonic() - start) * 1000
+            with self.lock:
+                metric = self.metrics.setdefault(operation, {"count": 0, "totalMs": 0.0, "maxMs": 0.0})
+                metric["count"] += 1
+                metric["totalMs"] += elapsed
+                metric["maxMs"] = max(metric["maxMs"], elapsed)
+
+    def hashpw(self, password, salt, operation="hash"):
+        """
+            bcrypt.hashpw on the pool, used both to hash and to verify
+        """
+        return self.run(operation, hashInWorker, password, salt)
+
+    def stats(self):
+        """
+            Per operation latency, in milliseconds, and rejected calls
+        """
+        with self.lock:
+            return {
+                "rejected": self.rejected,
+                "operations": {operation: dict(metric, avgMs=metric["totalMs"] / metric["count"])
+                               for operation, metric in self.metrics.items()}
+            }
+
+
+class CredentialCache:
+    """
+        Short lived, bounded cache of successful password verifications.
+        Entries are keyed by the username and an HMAC of the password and the
+        stored bcrypt hash under a random per-process key: no plaintext is kept
+        and an entry stops matching as soon as the stored hash changes
+    """
+    def __init__(self, ttlSeconds=300, maxEntries=10000):
+        self.ttl = ttlSeconds
+        self.maxEntries = maxEntries
+        self.key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, password, hashed_pw):
+        return hmac.new(self.key, password.encode('utf8') + b"\0" + hashed_pw, hashlib.sha256).digest()
+
+    def check(self, username, password, hashed_pw):
+        """
+            True if these credentials were verified less than ttl seconds ago
+        """
+        key = (username, self.digest(password, hashed_pw))
+        now = time.monotonic()
+        with self.lock:
+            expiry = self.entries.get(key)
+            if expiry is not None and expiry > now:
+                self.hits += 1
+                return True
+            if expiry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, username, password, hashed_pw):
+        key = (username, self.digest(password, hashed_pw))
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """
+            Drops every entry of a user, e.g. after a password change
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == username]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries)
+            }
+
+
+cryptoExecutor = CryptoExecutor()
+
+credentialCache = CredentialCache(ttlSeconds=int(os.environ.get("CREDENTIAL_CACHE_TTL", 300)),
+                                  maxEntries=int(os.environ.get("CREDENTIAL_CACHE_SIZE", 10000)))
+
+
+def checkPassword(username, password, hashed_pw):
+    """
+        Auxiliar function that checks a password against its stored bcrypt hash. Repeated
+        calls with the same credentials are answered from the cache, the first one always
+        runs the full bcrypt verification on the crypto pool. Return True or False, raise
+        CryptoBusy if the pool is saturated
+    """
+    if credentialCache.check(username, password, hashed_pw):
+        return True
+
+    if cryptoExecutor.hashpw(password.encode('utf8'), hashed_pw, "verify") == hashed_pw:
+        credentialCache.add(username, password, hashed_pw)
+        return True
+
+    return False
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionTokens:
+    """
+        Signed, expiring bearer tokens. A token is the base64 JSON payload
+        (username, expiry, token id) followed by its HMAC-SHA256 signature, so
+        verifying one needs no MongoDB lookup. Revoked token ids are kept in
+        memory and re-read from the revoked collection every syncSeconds, which
+        is how a logout on one worker reaches the others
+    """
+    def __init__(self, revoked, secret=TOKEN_SECRET, ttlSeconds=TOKEN_TTL, syncSeconds=REVOCATION_SYNC_SECONDS):
+        self.revoked = revoked
+        self.secret = secret
+        self.ttl = ttlSeconds
+        self.syncSeconds = syncSeconds
+        self.lock = threading.Lock()
+        self.revokedIds = set()
+        self.localRevoked = {}
+        self.lastSync = 0
+
+    def createIndexes(self):
+        """
+            Revoked ids are dropped by MongoDB once their token has expired
+        """
+        self.revoked.create_index("ExpiresAt", expireAfterSeconds=0)
+
+    def sign(self, payload):
+        return b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, username):
+        """
+            Returns a new token for a user already authenticated
+        """
+        payload = b64encode(json.dumps({
+            "sub": username,
+            "exp": int(time.time()) + self.ttl,
+            "jti": secrets.token_hex(16)
+        }).encode('utf8'))
+        return f"{payload}.{self.sign(payload)}"
+
+    def decode(self, token):
+        """
+            Returns the payload of a token with a valid signature, or None
+        """
+        # Tokens are base64url, any other character makes them invalid
+        try:
+            token.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        payload, _, signature = token.partition(".")
+        if not hmac.compare_digest(signature.encode('ascii'), self.sign(payload).encode('ascii')):
+            return None
+        try:
+            return json.loads(b64decode(payload))
+        except ValueError:
+            return None
+
+    def verify(self, token):
+        """
+            Returns the username of a valid, unexpired and not revoked token, or None
+        """
+        claims = self.decode(token)
+        if claims is None or claims["exp"] < time.time():
+            return None
+
+        if time.monotonic() - self.lastSync > self.syncSeconds:
+            self.sync()
+        if claims["jti"] in self.revokedIds:
+            return None
+        return claims["sub"]
+
+    def revoke(self, token):
+        """
+            Revokes a token until it expires. Return False if the token isn't valid
+        """
+        claims = self.decode(token)
+        if claims is None:
+            return False
+
+        with self.lock:
+            self.revokedIds.add(claims["jti"])
+            self.localRevoked[claims["jti"]] = claims["exp"]
+        self.revoked.replace_one({"_id": claims["jti"]}, {
+            "_id": claims["jti"],
+            "ExpiresAt": datetime.datetime.utcfromtimestamp(claims["exp"])
+        }, upsert=True)
+        return True
+
+    def sync(self):
+        """
+            Reloads the revoked token ids from MongoDB
+        """
+        now = datetime.datetime.utcnow()
+        revokedIds = {doc["_id"] for doc in self.revoked.find({"ExpiresAt": {"$gt": now}}, {"_id": 1})}
+        with self.lock:
+            # Tokens revoked by this worker while the query ran are kept too
+            self.localRevoked = {jti: exp for jti, exp in self.localRevoked.items() if exp > time.time()}
+            self.revokedIds = revokedIds | set(self.localRevoked)
+            self.lastSync = time.monotonic()
+
+
+def bearerToken():
+    """
+        Auxiliar function that returns the bearer token of the current request, or None
+    """
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[len("Bearer "):].strip()
+    return None
+
+
+def hashPassword(password):
+    """
+        Auxiliar function that hashes a new password with bcrypt on the crypto pool.
+        Raise CryptoBusy if the pool is saturated
+    """
+    return cryptoExecutor.hashpw(password.encode('utf8'), bcrypt.gensalt())
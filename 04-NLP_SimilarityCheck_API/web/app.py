@@ -2,18 +2,43 @@
 
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g
 from flask_restful import Api, Resource
-from pymongo import MongoClient
-import bcrypt
-import spacy
+from pymongo import MongoClient, monitoring
+from pymongo.errors import DuplicateKeyError
+import os
+from nlp_model import ModelManager, docVectors, cosineMatrix
+from vector_cache import VectorCache, normalizeText, textKey
+from corpus_index import CorpusIndex
+from auth import checkPassword, hashPassword, SessionTokens, bearerToken, cryptoExecutor
+from token_ledger import TokenLedger
+import numpy
 
 app = Flask(__name__)
 api = Api(app)
 
+class CommandCounter(monitoring.CommandListener):
+    """
+        Counts the commands sent to MongoDB, tests read mongoOps.count, or the mongoOps of
+        /metrics, before and after a call to know how many round trips an endpoint makes
+    """
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongoOps = CommandCounter()
+
 # When the mongoDB client is created //db must be the same name defined in the file 
 # docker-compose.yml for the mongoDB container
-client = MongoClient("mongodb://db:27017")
+client = MongoClient("mongodb://db:27017", event_listeners=[mongoOps])
 
 #Step 1: create a DB
 db = client.SimilarityDB
@@ -21,72 +46,147 @@ db = client.SimilarityDB
 # Step 2: create collections
 users = db["Users"]
 
+# Fields of the user document the API reads
+USER_FIELDS = {"_id": 0, "Username": 1, "Password": 1, "Tokens": 1}
+
+# Tokens are charged and refilled with atomic updates
+tokenLedger = TokenLedger(users)
+
+# Signed session tokens, revoked ones are tracked in RevokedTokens
+sessions = SessionTokens(db["RevokedTokens"])
+
+# Start the bcrypt worker processes before the web server starts its threads
+cryptoExecutor.warmUp()
+
+# Step 3: load the spaCy pipeline once per worker and warm it up before serving
+nlpModel = ModelManager(os.environ.get("SPACY_MODEL", "en_core_web_sm"))
+nlpModel.warmUp()
+
+# nlp.pipe settings and the max number of texts of /detectBatch
+PIPE_BATCH_SIZE = int(os.environ.get("PIPE_BATCH_SIZE", 256))
+PIPE_N_PROCESS = int(os.environ.get("PIPE_N_PROCESS", 1))
+MAX_BATCH_TEXTS = int(os.environ.get("MAX_BATCH_TEXTS", 10000))
+
+# Step 4: document vectors are cached by text hash in memory and, when
+# VECTOR_CACHE_DB is set, in the Vectors collection
+vectorCache = VectorCache(db["Vectors"] if os.environ.get("VECTOR_CACHE_DB") else None,
+                          maxBytes=int(os.environ.get("VECTOR_CACHE_BYTES", 64 * 1024 * 1024)))
+
+# Step 5: documents of the per-user corpora live in the Documents collection,
+# their vectors in memory-mapped float32 files under CORPUS_DIR, a volume of
+# docker-compose.yml. The next DocId of every corpus is kept in Corpora
+corpus = CorpusIndex(db["Documents"], db["Corpora"], os.environ.get("CORPUS_DIR", "./corpus"))
+MAX_SEARCH_RESULTS = 100
+
+def createIndexes():
+    """
+        Creates the indexes the queries of the API need. create_index does nothing when
+        the index already exists, so every worker runs it at start
+    """
+    # Every query looks users up by Username, unique so /register can't create duplicates
+    users.create_index("Username", unique=True)
+    sessions.createIndexes()
+    corpus.createIndexes()
+
+createIndexes()
+
 """ 
 ****************************AUXILIAR FUNTCIONS***********************************
 """
+def loadUser(username):
+    """
+        Auxiliar function that returns the document of a user, or None. The document is read
+        once per request, with only the fields listed in USER_FIELDS, and every helper
+        reuses it. Helpers that write the user document call invalidateUser
+    """
+    loaded = g.setdefault("users", {})
+    if username not in loaded:
+        loaded[username] = users.find_one({"Username": username}, USER_FIELDS)
+    return loaded[username]
+
+def invalidateUser(username):
+    """
+        Auxiliar function that drops the memoized document of a user after a write
+    """
+    g.get("users", {}).pop(username, None)
+
 def userExist(username):
     """
         Auxiliar function to check if a username already exists in the DB.
         Return True if exists, otherwise returns False
     """
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    if users.find(SELECTION_CRITERIA).count() > 0:
-        return True
-    else:
-        return False
+    return loadUser(username) is not None
 
-def verifyPw(username,password):
+def verifyPassword(username,password):
     """
-        Auxiliar function to verify the username and password. Return True or False
+        Auxiliar function to verify the username and password, ignoring any bearer
+        token. Return True or False
     """
+    if password is None:
+        return False
+
     if not userExist(username):
         return False
 
-    hashed_pw = users.find({"Username": username})[0]["Password"]
+    hashed_pw = loadUser(username)["Password"]
 
-    if bcrypt.hashpw(password.encode('utf8'),hashed_pw) == hashed_pw:
-        return True
-    
-    return False
+    return checkPassword(username, password, hashed_pw)
 
-def getTokens(username):
+def verifyPw(username,password):
     """
-        Auxiliar function returns number of tokens a username have
+        Auxiliar function to verify the username and password. Return True or False.
+        A bearer token in the request replaces the password
     """
-    tokens = users.find({"Username": username})[0]["Tokens"]
-    return tokens
+    token = bearerToken()
+    if token is not None:
+        return sessions.verify(token) == username
+
+    return verifyPassword(username, password)
 
-def takeOneToken(username):
+def takeTokens(username, amount=1):
     """
-        Auxiliar function that update the DB taking one token away from the username
+        Auxiliar function that takes amount tokens away in a single atomic update.
+        Return False, without charging anything, if the user has less than amount tokens
     """
-    tokens = getTokens(username)
-        
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Tokens": tokens - 1
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    invalidateUser(username)
+    return tokenLedger.charge(username, amount) is not None
 
 def refillTokens(username, tokensAumount):
     """
-        Auxiliar function to refill the number of tokens of a specific user
+        Auxiliar function to refill the number of tokens of a specific user, atomically.
+        Return the new amount of tokens
+    """
+    invalidateUser(username)
+    return tokenLedger.refill(username, tokensAumount)
+
+def isTextList(texts):
+    """
+        Auxiliar function that checks texts is a list of strings, the only texts
+        textVectors accepts. Checked before any token is charged
     """
-    tokens = getTokens(username) + tokensAumount
-        
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Tokens": tokens
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    return isinstance(texts, list) and all(isinstance(text, str) for text in texts)
 
-    return tokens
+def textVectors(texts):
+    """
+        Auxiliar function that returns the document vectors of a list of texts as the rows
+        of a float32 matrix. Cached texts skip the spaCy pipeline, the rest go through
+        nlp.pipe in a single pass
+    """
+    modelName = nlpModel.name
+    texts = [normalizeText(text) for text in texts]
+    keys = [textKey(modelName, text) for text in texts]
+    vectors = [vectorCache.get(key) for key in keys]
+
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing:
+        computed = dict(zip(missing, docVectors(nlpModel.get(), missing, PIPE_BATCH_SIZE, PIPE_N_PROCESS)))
+        for text, vector in computed.items():
+            vectorCache.put(textKey(modelName, text), vector)
+        vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+
+    if not vectors:
+        return numpy.zeros((0, 0), dtype=numpy.float32)
+    return numpy.stack(vectors)
 
 class Register(Resource):
     """
@@ -103,32 +203,90 @@ class Register(Resource):
         username = postedData["username"]
         password = postedData["password"]
 
-        # Step 3: Check if user already exists
-        if userExist(username):
+        # Step 3: Hash the password with bcrypt, on the crypto pool
+        hashed_pw = hashPassword(password)
+
+        # Step 4: Store the username, password and the amount of tokens into the DB
+        # The unique index on Username rejects a user that already exists
+        try:
+            users.insert_one({
+                "Username": username,
+                "Password": hashed_pw,
+                "Tokens": 6
+
+            })
+        except DuplicateKeyError:
             retJson = {
                 "status": 301,
                 "msg": f"Invalid username. User {username} already exists"
             }
             return jsonify(retJson)
 
-        # Step 4: Hash the password with bcrypt
-        hashed_pw = bcrypt.hashpw(password.encode('utf8'),bcrypt.gensalt())
+        # Step 5: Return message to the user
+        retJson = {
+            "status": 200,
+            "msg": "You successfully signed up for the API"
+        }
 
-        # Step 4: Store the username, password and the amount of tokens into the DB
-        users.insert({
-            "Username": username,
-            "Password": hashed_pw,
-            "Tokens": 6
+        return jsonify(retJson)
 
-        })
+class Login(Resource):
+    """
+        Class to open a session
+    """
+    def post(self):
+        """
+            POST Function that exchanges the username and password for a bearer token.
+            The other resources accept the header "Authorization: Bearer <token>"
+            instead of the password until the token expires
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
 
-        # Step 5: Return message to the user
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData["password"]
+
+        # Step 3: Verify the username and password match. A token can't open a
+        # new session, the password is always required
+        correct_pw = verifyPassword(username, password)
+        if not correct_pw:
+            retJson = {
+                "status": 302,
+                "msg": "Invalid username or password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Issue the token
         retJson = {
             "status": 200,
-            "msg": "You successfully signed up for the API"
+            "token": sessions.issue(username),
+            "expiresIn": sessions.ttl
         }
+        return jsonify(retJson)
 
+class Logout(Resource):
+    """
+        Class to close a session
+    """
+    def post(self):
+        """
+            POST Function that revokes the bearer token of the request
+        """
+        token = bearerToken()
+        if token is None or not sessions.revoke(token):
+            retJson = {
+                "status": 302,
+                "msg": "Invalid session token"
+            }
+            return jsonify(retJson)
+
+        retJson = {
+            "status": 200,
+            "msg": "Session closed"
+        }
         return jsonify(retJson)
+
 """ 
 ************************end AUXILIAR FUNTCIONS***********************************
 """
@@ -149,12 +307,20 @@ class Detect(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         text1    = postedData["text1"]
         text2    = postedData["text2"]
 
-        # Step 3: Check if user already exists
-        if not userExist(username):
+        if not isTextList([text1, text2]):
+            retJson = {
+                "status": 303,
+                "msg": "text1 and text2 must be strings"
+            }
+            return jsonify(retJson)
+
+        # Step 3: Check if user already exists. A bearer token is signed for an
+        # existing user, checking it needs no MongoDB lookup
+        if bearerToken() is None and not userExist(username):
             retJson = {
                 "status": 301,
                 "msg": f"Invalid username. User {username} already exists"
@@ -170,29 +336,28 @@ class Detect(Resource):
             }
             return jsonify(retJson)       
 
-        # Step 5: Verify user has enough tokens
-        tokens = getTokens(username)
-        if tokens <= 0:
+        # Step 5: Take one token away, nothing is charged if the user has no tokens left
+        if not takeTokens(username):
             retJson = {
                 "status": 303,
                 "msg": "You are out of tokens, please refill"
             }
             return jsonify(retJson)
 
-        # Step 6: Calculate the similarity between text1 and text2 
-        # Step 6.1: Calculating the Edit Distance with spacy
-        nlp = spacy.load('en_core_web_sm')
-
-        text1 = nlp(text1)
-        text2 = nlp(text2)
-
-        # Step 6.2: Calculate the ratio. Ratio is a number between 0 and 1.
-        # The closer to 1, the more similar text1 and text2 are
-        ratio = text1.similarity(text2)
+        # Step 6: Calculate the similarity between text1 and text2, the token is
+        # given back if it fails
+        try:
+            # Step 6.1: Get the document vectors, repeated texts come from the cache
+            vectors = textVectors([text1, text2])
 
-        # Step 7: Take one token away and return 200 OK
-        takeOneToken(username)
+            # Step 6.2: Calculate the ratio. Ratio is a number between 0 and 1.
+            # The closer to 1, the more similar text1 and text2 are
+            ratio = float(cosineMatrix(vectors[:1], vectors[1:])[0][0])
+        except Exception:
+            refillTokens(username, 1)
+            raise
 
+        # Step 7: Return 200 OK
         retJson = {
             "status": 200,
             "similarity": ratio,
@@ -201,6 +366,199 @@ class Detect(Resource):
 
         return jsonify(retJson)
 
+class DetectBatch(Resource):
+    """
+        Class to detect the similarity of many texts in one call
+    """
+    def post(self):
+        """
+            POST Function that scores one text against a list of candidates ("text1" and
+            "candidates"), or every text of "texts1" against every text of "texts2".
+            Every score costs one token
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData.get("password")
+        if "text1" in postedData:
+            texts1 = [postedData["text1"]]
+            texts2 = postedData["candidates"]
+        else:
+            texts1 = postedData["texts1"]
+            texts2 = postedData["texts2"]
+
+        if not isTextList(texts1) or not isTextList(texts2):
+            retJson = {
+                "status": 303,
+                "msg": "text1 must be a string, candidates, texts1 and texts2 lists of strings"
+            }
+            return jsonify(retJson)
+
+        if len(texts1) + len(texts2) > MAX_BATCH_TEXTS:
+            retJson = {
+                "status": 306,
+                "msg": f"A batch can't have more than {MAX_BATCH_TEXTS} texts"
+            }
+            return jsonify(retJson)
+
+        # Step 3: Verify if the username and password match
+        correct_pw = verifyPw(username, password)
+        if not correct_pw:
+            retJson = {
+                "status": 302,
+                "msg": "Invalid username or password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Take one token per score away in a single atomic update
+        scores = len(texts1) * len(texts2)
+        if not takeTokens(username, scores):
+            retJson = {
+                "status": 303,
+                "msg": f"You need {scores} tokens for this batch, please refill"
+            }
+            return jsonify(retJson)
+
+        # Step 5: Vectorize every text, cached ones skip nlp.pipe, and score every pair
+        # with a single matrix multiply. The tokens are given back if it fails
+        try:
+            vectors = textVectors(texts1 + texts2)
+            ratios = cosineMatrix(vectors[:len(texts1)], vectors[len(texts1):])
+        except Exception:
+            refillTokens(username, scores)
+            raise
+
+        retJson = {
+            "status": 200,
+            "similarity": ratios[0].tolist() if "text1" in postedData else ratios.tolist(),
+            "msg": "Similarity scores calculated successfully"
+        }
+        return jsonify(retJson)
+
+class AddDocuments(Resource):
+    """
+        Class to add documents to the corpus of a user
+    """
+    def post(self):
+        """
+            POST Function that stores a list of documents and their vectors. Every
+            document costs one token
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username  = postedData["username"]
+        password  = postedData.get("password")
+        documents = postedData["documents"]
+
+        if not isTextList(documents):
+            retJson = {
+                "status": 303,
+                "msg": "documents must be a list of strings"
+            }
+            return jsonify(retJson)
+
+        if not documents or len(documents) > MAX_BATCH_TEXTS:
+            retJson = {
+                "status": 306,
+                "msg": f"Send between 1 and {MAX_BATCH_TEXTS} documents"
+            }
+            return jsonify(retJson)
+
+        # Step 3: Verify if the username and password match
+        correct_pw = verifyPw(username, password)
+        if not correct_pw:
+            retJson = {
+                "status": 302,
+                "msg": "Invalid username or password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Take one token per document away in a single atomic update
+        if not takeTokens(username, len(documents)):
+            retJson = {
+                "status": 303,
+                "msg": f"You need {len(documents)} tokens for these documents, please refill"
+            }
+            return jsonify(retJson)
+
+        # Step 5: Vectorize and store the documents, in the corpus of the current model.
+        # The tokens are given back if they can't be stored
+        modelName = nlpModel.name
+        try:
+            docIds = corpus.add(username, modelName, documents, textVectors(documents))
+        except Exception:
+            refillTokens(username, len(documents))
+            raise
+
+        retJson = {
+            "status": 200,
+            "docIds": docIds,
+            "msg": f"{len(docIds)} documents added to your corpus"
+        }
+        return jsonify(retJson)
+
+class SearchSimilar(Resource):
+    """
+        Class to find the stored documents most similar to a text
+    """
+    def post(self):
+        """
+            POST Function that returns the top k documents of the corpus of a user. The
+            search is exact unless "approximate" is true
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username    = postedData["username"]
+        password    = postedData.get("password")
+        text        = postedData["text"]
+        k           = min(int(postedData.get("k", 10)), MAX_SEARCH_RESULTS)
+        approximate = bool(postedData.get("approximate", False))
+
+        if not isinstance(text, str):
+            retJson = {
+                "status": 303,
+                "msg": "text must be a string"
+            }
+            return jsonify(retJson)
+
+        # Step 3: Verify if the username and password match
+        correct_pw = verifyPw(username, password)
+        if not correct_pw:
+            retJson = {
+                "status": 302,
+                "msg": "Invalid username or password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Take one token away
+        if not takeTokens(username, 1):
+            retJson = {
+                "status": 303,
+                "msg": "You are out of tokens, please refill"
+            }
+            return jsonify(retJson)
+
+        # Step 5: Search the corpus, the token is given back if it fails
+        modelName = nlpModel.name
+        try:
+            results = corpus.search(username, modelName, textVectors([text])[0], k, approximate)
+        except Exception:
+            refillTokens(username, 1)
+            raise
+
+        retJson = {
+            "status": 200,
+            "results": [{"docId": docId, "text": doc, "similarity": score} for docId, doc, score in results],
+            "msg": "Search completed successfully"
+        }
+        return jsonify(retJson)
+
 class Refill(Resource):
     """
         An Admin can refill the amount of tokens to a specific user
@@ -243,6 +601,61 @@ class Refill(Resource):
         }
         return jsonify(retJson)       
 
+class Metrics(Resource):
+    """
+        Metrics of this worker
+    """
+    def get(self):
+        """
+            GET Function that returns the vector cache metrics
+        """
+        return jsonify({
+            "model": nlpModel.name,
+            "vectorCache": vectorCache.stats(),
+            "crypto": cryptoExecutor.stats(),
+            "mongoOps": mongoOps.count
+        })
+
+class Model(Resource):
+    """
+        An Admin can swap the spaCy model without restarting the API
+    """
+    def post(self):
+        """
+            POST Function that loads a new spaCy model and starts using it
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        admPsswd = postedData["admin_pw"]
+        modelName = postedData["model"]
+
+        # Step 3: Verify if the admin password match
+        correct_admPsswd = "abc123" #later make a collection to store the correct admin pw. Now is hardcoded
+        if correct_admPsswd != admPsswd:
+            retJson = {
+                "status": 304,
+                "msg": "Invalid Admin password"
+            }
+            return jsonify(retJson)
+
+        # Step 4: Load the new model, the current one keeps serving until it is ready
+        try:
+            nlpModel.swap(modelName)
+        except OSError:
+            retJson = {
+                "status": 305,
+                "msg": f"Model {modelName} could not be loaded"
+            }
+            return jsonify(retJson)
+
+        retJson = {
+            "status": 200,
+            "msg": f"Model {modelName} loaded successfully"
+        }
+        return jsonify(retJson)
+
 """ 
 ********************end API Resources Class definition****************************
 """
@@ -252,8 +665,15 @@ class Refill(Resource):
 ********************Adding the resources to the API****************************
 """
 api.add_resource(Register,'/register')
+api.add_resource(Login,'/login')
+api.add_resource(Logout,'/logout')
 api.add_resource(Detect,'/detect')
+api.add_resource(DetectBatch,'/detectBatch')
+api.add_resource(AddDocuments,'/addDocuments')
+api.add_resource(SearchSimilar,'/searchSimilar')
 api.add_resource(Refill,'/refill')
+api.add_resource(Model,'/model')
+api.add_resource(Metrics,'/metrics')
 """ 
 ****************end Adding the resources to the API****************************
 """
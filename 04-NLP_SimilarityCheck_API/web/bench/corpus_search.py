@@ -0,0 +1,113 @@
+"""
+    Benchmark of the corpus search of /searchSimilar on synthetic vectors:
+    build time and memory of the IVFIndex, then latency of the exact and
+    the approximate search and the recall of the approximate one. The
+    vectors are written to a raw float32 file and read through
+    numpy.memmap, as CorpusIndex stores them. Runs anywhere the web
+    requirements are installed, e.g.:
+
+        docker-compose exec web python bench/corpus_search.py
+
+    1M rows of 96 floats take 384 MB of disk, under --directory
+"""
+
+import argparse
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus_index import IVFIndex
+from nlp_model import normalizeRows
+
+
+def writeVectors(path, rows, dim, clusters, rng):
+    """
+        Writes rows unit vectors spread around random centers, in chunks, and
+        returns them memory-mapped
+    """
+    centers = normalizeRows(rng.standard_normal((clusters, dim)).astype(numpy.float32))
+    with open(path, "wb") as f:
+        for start in range(0, rows, 65536):
+            count = min(65536, rows - start)
+            chunk = centers[rng.integers(clusters, size=count)]
+            chunk += 0.5 / numpy.sqrt(dim) * rng.standard_normal((count, dim)).astype(numpy.float32)
+            normalizeRows(chunk).astype(numpy.float32).tofile(f)
+    return numpy.memmap(path, dtype=numpy.float32, mode="r", shape=(rows, dim))
+
+def exactTop(vectors, query, k):
+    scores = numpy.asarray(vectors @ query)
+    top = numpy.argpartition(-scores, k - 1)[:k]
+    return top[numpy.argsort(-scores[top])]
+
+def approximateTop(vectors, index, query, k, nprobe):
+    rows = index.candidates(query, nprobe)
+    scores = vectors[rows] @ query
+    top = numpy.argpartition(-scores, min(k, len(rows)) - 1)[:k]
+    return rows[top[numpy.argsort(-scores[top])]]
+
+def timeQueries(function, queries):
+    seconds = []
+    results = []
+    for query in queries:
+        start = time.monotonic()
+        results.append(function(query))
+        seconds.append(time.monotonic() - start)
+    return sorted(seconds), results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,1000000")
+    parser.add_argument("--dim", type=int, default=96)
+    parser.add_argument("--clusters", type=int, default=1000, help="centers the synthetic vectors are spread around")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--directory", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    print(f"{'rows':>9}{'build s':>9}{'index MB':>10}{'peak MB':>9}"
+          f"{'exact p50':>11}{'approx p50':>12}{'recall':>8}")
+    for rows in [int(size) for size in args.sizes.split(",")]:
+        rng = numpy.random.default_rng(rows)
+        path = os.path.join(args.directory, f"corpus-bench-{rows}.f32")
+        try:
+            vectors = writeVectors(path, rows, args.dim, args.clusters, rng)
+
+            tracemalloc.start()
+            start = time.monotonic()
+            index = IVFIndex(vectors)
+            build = time.monotonic() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            indexBytes = index.centroids.nbytes + sum(ids.nbytes for ids in index.lists)
+
+            # Queries are noisy copies of rows of the corpus
+            picks = numpy.asarray(vectors[numpy.sort(rng.choice(rows, args.queries, replace=False))])
+            queries = normalizeRows(picks + 0.1 / numpy.sqrt(args.dim) * rng.standard_normal(picks.shape).astype(numpy.float32))
+
+            exactSeconds, exact = timeQueries(lambda query: exactTop(vectors, query, args.k), queries)
+            approxSeconds, approx = timeQueries(
+                lambda query: approximateTop(vectors, index, query, args.k, args.nprobe), queries)
+            recall = statistics.mean(len(set(a.tolist()) & set(e.tolist())) / args.k for a, e in zip(approx, exact))
+
+            print(f"{rows:>9}{build:>9.2f}{indexBytes / 2**20:>10.1f}{peak / 2**20:>9.1f}"
+                  f"{statistics.median(exactSeconds) * 1000:>9.2f}ms{statistics.median(approxSeconds) * 1000:>10.2f}ms"
+                  f"{recall:>8.3f}")
+            del vectors
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    print(f"max RSS of the process {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+    Compares the similarity step of /detect as it was, spacy.load on every
+    call with the whole pipeline, with the resident ModelManager pipeline
+    the API loads once per worker. Run it in the web container, where the
+    spaCy model is installed:
+
+        docker-compose exec web python bench/model_latency.py
+
+    Only the model work is timed, the HTTP and MongoDB costs of /detect are
+    the same in both cases
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import spacy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nlp_model import ModelManager
+
+TEXT1 = "The quick brown fox jumps over the lazy dog near the river bank"
+TEXT2 = "A fast brown fox leaps over a sleepy dog by the side of the river"
+
+
+def timeCalls(function, calls):
+    seconds = []
+    for _ in range(calls):
+        start = time.monotonic()
+        function()
+        seconds.append(time.monotonic() - start)
+    return sorted(seconds)
+
+def summary(name, seconds):
+    p95 = seconds[int(len(seconds) * 0.95)]
+    print(f"{name:<22}{statistics.median(seconds) * 1000:>10.1f}{p95 * 1000:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.environ.get("SPACY_MODEL", "en_core_web_sm"))
+    parser.add_argument("--cold-calls", type=int, default=10)
+    parser.add_argument("--warm-calls", type=int, default=200)
+    args = parser.parse_args()
+
+    def cold():
+        nlp = spacy.load(args.model)
+        nlp(TEXT1).similarity(nlp(TEXT2))
+
+    manager = ModelManager(args.model)
+    start = time.monotonic()
+    manager.warmUp()
+    startup = time.monotonic() - start
+
+    def warm():
+        nlp = manager.get()
+        nlp(TEXT1).similarity(nlp(TEXT2))
+
+    coldSeconds = timeCalls(cold, args.cold_calls)
+    warmSeconds = timeCalls(warm, args.warm_calls)
+
+    print(f"resident startup      {startup * 1000:.1f} ms")
+    print(f"{'per call':<22}{'p50 ms':>10}{'p95 ms':>10}")
+    summary("cold (spacy.load)", coldSeconds)
+    summary("warm (ModelManager)", warmSeconds)
+    print(f"speedup (p50)         {statistics.median(coldSeconds) / statistics.median(warmSeconds):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
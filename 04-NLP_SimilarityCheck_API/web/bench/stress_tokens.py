@@ -0,0 +1,86 @@
+"""
+    Concurrent token accounting stress test of the NLP API. Gives a fresh
+    user a known number of tokens, then sends more /detect calls than it can
+    pay for from many clients at once. With atomic charges exactly as many
+    calls as tokens succeed and the balance ends at 0: a lost update would
+    let extra calls through for free. Start the API with docker-compose up,
+    then:
+
+        docker-compose exec web python bench/stress_tokens.py
+
+    The MongoDB commands per call come from the mongoOps counter of
+    /metrics, they are exact only if nothing else uses the API meanwhile
+"""
+
+import argparse
+import json
+import re
+import secrets
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ADMIN_PW = "abc123"
+
+
+def call(base, method, path, body=None):
+    data = None if body is None else json.dumps(body).encode('utf8')
+    request = urllib.request.Request(base + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())
+
+def refill(base, username, amount):
+    """
+        Adds amount tokens, returns the new balance
+    """
+    retJson = call(base, "POST", "/refill", {"username": username, "admin_pw": ADMIN_PW, "refill": amount})
+    return int(re.search(r"now have (-?\d+) tokens", retJson["msg"]).group(1))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--extra", type=int, default=100, help="calls sent beyond the tokens")
+    parser.add_argument("--clients", type=int, default=32)
+    args = parser.parse_args()
+
+    username = f"stress-{secrets.token_hex(4)}"
+    call(args.url, "POST", "/register", {"username": username, "password": "pw"})
+    tokens = refill(args.url, username, args.tokens)
+
+    # A session token avoids bcrypt, every call only pays its token charge
+    token = call(args.url, "POST", "/login", {"username": username, "password": "pw"})["token"]
+
+    def detect(n):
+        request = urllib.request.Request(args.url + "/detect", headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}"
+        }, data=json.dumps({"username": username, "text1": "stress test", "text2": f"call {n % 10}"}).encode('utf8'))
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return json.loads(response.read())["status"]
+
+    calls = tokens + args.extra
+    opsBefore = call(args.url, "GET", "/metrics")["mongoOps"]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        statuses = Counter(executor.map(detect, range(calls)))
+    seconds = time.monotonic() - start
+    ops = call(args.url, "GET", "/metrics")["mongoOps"] - opsBefore
+
+    left = refill(args.url, username, 0)
+    print(f"tokens given         {tokens}")
+    print(f"calls sent           {calls} from {args.clients} clients")
+    print(f"statuses             {dict(statuses)}")
+    print(f"tokens left          {left}")
+    print(f"mongo ops per call   {ops / calls:.2f}")
+    print(f"calls/second         {calls / seconds:.1f}")
+
+    ok = statuses[200] == tokens and statuses[303] == args.extra and left == 0
+    print("no lost updates" if ok else "LOST UPDATES")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+    Per-user corpus of documents searchable by similarity
+"""
+
+import hashlib
+import os
+import re
+
+import numpy
+from pymongo import ASCENDING, ReturnDocument
+
+from nlp_model import normalizeRows
+
+
+class IVFIndex:
+    """
+        Approximate inverted file index: rows are clustered with k-means and a
+        query only scans the rows of its nprobe closest clusters
+    """
+    def __init__(self, vectors, nlist=None, iterations=10, sampleSize=50000, seed=0):
+        rows = len(vectors)
+        self.nlist = nlist or max(1, int(numpy.sqrt(rows)))
+        self.rows = rows
+
+        rng = numpy.random.default_rng(seed)
+        sample = vectors[numpy.sort(rng.choice(rows, min(rows, sampleSize), replace=False))]
+        self.centroids = sample[rng.choice(len(sample), min(self.nlist, len(sample)), replace=False)].copy()
+
+        # Spherical k-means, the rows are unit vectors so the closest centroid
+        # is the one with the highest dot product
+        for _ in range(iterations):
+            assignment = numpy.argmax(sample @ self.centroids.T, axis=1)
+            for cluster in range(len(self.centroids)):
+                members = sample[assignment == cluster]
+                if len(members):
+                    self.centroids[cluster] = members.sum(axis=0)
+            self.centroids = normalizeRows(self.centroids)
+
+        # Assign every row in chunks so a memory-mapped corpus is never read
+        # in full at once
+        assignment = numpy.empty(rows, dtype=numpy.int32)
+        for start in range(0, rows, 65536):
+            chunk = numpy.asarray(vectors[start:start + 65536])
+            assignment[start:start + 65536] = numpy.argmax(chunk @ self.centroids.T, axis=1)
+        order = numpy.argsort(assignment, kind="stable")
+        bounds = numpy.searchsorted(assignment[order], numpy.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+
+    def candidates(self, query, nprobe):
+        """
+            Row ids in the nprobe clusters closest to the query
+        """
+        closest = numpy.argsort(-(self.centroids @ query))[:nprobe]
+        return numpy.sort(numpy.concatenate([self.lists[c] for c in closest]))
+
+
+class CorpusIndex:
+    """
+        Stores the documents of every user in MongoDB and their unit length
+        vectors in raw float32 files, read through numpy.memmap. Vectors of
+        different models don't compare, so a user has one corpus, and one
+        file, per model name and vector width. The row of a vector in the
+        file is the DocId of its document.
+
+        The next DocId of every corpus is kept in the counters collection and
+        reserved with one $inc, each batch of vectors is written at the rows
+        of its DocIds. Any number of workers can add documents, and a lost
+        file never makes DocIds start over: the rows of its vectors read as
+        zeros, until they are added again
+    """
+    def __init__(self, documents, counters, directory):
+        self.documents = documents
+        self.counters = counters
+        self.directory = directory
+        self.indexes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def createIndexes(self):
+        """
+            DocIds are unique per corpus. Indexes of older versions, with unique DocIds
+            per user, are dropped
+        """
+        if "Username_1_DocId_1" in self.documents.index_information():
+            self.documents.drop_index("Username_1_DocId_1")
+        self.documents.create_index([("Username", ASCENDING), ("Model", ASCENDING), ("Dim", ASCENDING),
+                                     ("DocId", ASCENDING)], unique=True)
+
+    def path(self, username, model, dim):
+        """
+            File of a corpus. The hash keeps usernames that only differ in the
+            characters replaced apart
+        """
+        safeName = re.sub(r"[^A-Za-z0-9_.-]", "_", username)
+        safeModel = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        digest = hashlib.sha1(username.encode('utf8')).hexdigest()[:8]
+        return os.path.join(self.directory, f"{safeName}-{digest}.{safeModel}.{dim}.f32")
+
+    def matrix(self, username, model, dim):
+        """
+            Memory-mapped [rows, dim] matrix of the vectors of a corpus
+        """
+        path = self.path(username, model, dim)
+        rows = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+        if rows == 0:
+            return numpy.zeros((0, dim), dtype=numpy.float32)
+        return numpy.memmap(path, dtype=numpy.float32, mode="r", shape=(rows, dim))
+
+    def reserve(self, username, model, dim, count):
+        """
+            Reserves count DocIds of a corpus, returns the first one
+        """
+        counter = self.counters.find_one_and_update(
+            {"_id": {"Username": username, "Model": model, "Dim": dim}},
+            {"$inc": {"NextDocId": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["NextDocId"] - count
+
+    def add(self, username, model, texts, vectors):
+        """
+            Adds documents to the corpus of a user for a model, returns their DocIds
+        """
+        vectors = normalizeRows(numpy.asarray(vectors, dtype=numpy.float32))
+        dim = vectors.shape[1]
+        first = self.reserve(username, model, dim, len(texts))
+
+        fd = os.open(self.path(username, model, dim), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, vectors.tobytes(), first * dim * 4)
+        finally:
+            os.close(fd)
+
+        docIds = list(range(first, first + len(texts)))
+        self.documents.insert_many([{
+            "Username": username,
+            "Model": model,
+            "Dim": dim,
+            "DocId": docId,
+            "Text": text
+        } for docId, text in zip(docIds, texts)])
+        return docIds
+
+    def buildIndex(self, username, model, dim, nlist=None):
+        """
+            Builds the approximate index of a corpus and keeps it in memory
+        """
+        vectors = self.matrix(username, model, dim)
+        if not len(vectors):
+            return None
+        index = IVFIndex(vectors, nlist)
+        self.indexes[(username, model, dim)] = index
+        return index
+
+    def search(self, username, model, query, k=10, approximate=False, nprobe=8):
+        """
+            Top k documents most similar to a query vector as (DocId, Text,
+            score) tuples. The exact search scans every row, the approximate
+            one scans the closest clusters of the index plus the rows added
+            after the index was built. Rows without a document, whose batch
+            failed to be stored, are left out
+        """
+        query = normalizeRows(numpy.asarray(query, dtype=numpy.float32).reshape(1, -1))[0]
+        dim = len(query)
+        vectors = self.matrix(username, model, dim)
+        if not len(vectors):
+            return []
+
+        index = None
+        if approximate:
+            # The index is (re)built on demand, once per doubling of the corpus
+            index = self.indexes.get((username, model, dim))
+            if index is None or len(vectors) > 2 * index.rows:
+                index = self.buildIndex(username, model, dim)
+
+        if index is not None:
+            rows = numpy.concatenate([index.candidates(query, nprobe), numpy.arange(index.rows, len(vectors))])
+            scores = vectors[rows] @ query
+        else:
+            rows = None
+            scores = numpy.asarray(vectors @ query)
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = numpy.argpartition(-scores, k - 1)[:k]
+        top = top[numpy.argsort(-scores[top])]
+        docIds = [int(rows[i]) if rows is not None else int(i) for i in top]
+
+        texts = {doc["DocId"]: doc["Text"] for doc in self.documents.find(
+            {"Username": username, "Model": model, "Dim": dim, "DocId": {"$in": docIds}},
+            {"_id": 0, "DocId": 1, "Text": 1})}
+        return [(docId, texts[docId], float(scores[i])) for docId, i in zip(docIds, top) if docId in texts]
+
+    def stats(self, username, model, dim):
+        """
+            Size of the corpus of a user and of its approximate index
+        """
+        vectors = self.matrix(username, model, dim)
+        index = self.indexes.get((username, model, dim))
+        return {
+            "documents": len(vectors),
+            "bytes": vectors.nbytes,
+            "indexedRows": index.rows if index else 0,
+            "clusters": len(index.lists) if index else 0
+        }
@@ -0,0 +1,87 @@
+"""
+    spaCy pipeline manager, one loaded pipeline per worker process
+"""
+
+import threading
+
+import numpy
+import spacy
+
+# Doc.similarity only needs the token vectors, the components that build
+# syntax, entities and lemmas are disabled
+DISABLED_COMPONENTS = ["parser", "ner", "lemmatizer"]
+
+
+class ModelManager:
+    """
+        Loads a spaCy pipeline once and hands the same instance to every
+        request. swap() loads another pipeline next to the current one and
+        replaces it in a single assignment, requests already running keep
+        the pipeline they started with
+    """
+    def __init__(self, name, disable=DISABLED_COMPONENTS):
+        self.name = name
+        self.disable = list(disable)
+        self.nlp = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+            Returns the loaded pipeline, loading it on first use
+        """
+        nlp = self.nlp
+        if nlp is None:
+            with self.lock:
+                if self.nlp is None:
+                    self.nlp = self.load(self.name)
+                nlp = self.nlp
+        return nlp
+
+    def load(self, name):
+        return spacy.load(name, disable=self.disable)
+
+    def warmUp(self, text="Warm up the pipeline before the first request"):
+        """
+            Loads the pipeline and runs it once so the first request doesn't
+            pay for lazy initialisation
+        """
+        self.get()(text)
+
+    def swap(self, name):
+        """
+            Hot-swaps to another model without restarting the process
+        """
+        nlp = self.load(name)
+        nlp("Warm up the pipeline before the first request")
+        with self.lock:
+            self.nlp = nlp
+            self.name = name
+
+
+def docVectors(nlp, texts, batchSize=256, nProcess=1):
+    """
+        Runs texts through nlp.pipe and returns their document vectors as the
+        rows of a float32 matrix
+    """
+    vectors = [doc.vector for doc in nlp.pipe(texts, batch_size=batchSize, n_process=nProcess)]
+    if not vectors:
+        return numpy.zeros((0, 0), dtype=numpy.float32)
+    return numpy.asarray(vectors, dtype=numpy.float32)
+
+
+def normalizeRows(vectors):
+    """
+        Scales every row to unit length. Rows with a zero norm stay zero, so
+        their similarity comes out as 0.0 like Doc.similarity does
+    """
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def cosineMatrix(vectors1, vectors2):
+    """
+        Cosine similarity of every row of vectors1 against every row of
+        vectors2, computed as a single matrix multiply
+    """
+    return normalizeRows(vectors1) @ normalizeRows(vectors2).T
@@ -0,0 +1,64 @@
+"""
+    Tests of the token charges of /detect and /detectBatch. They use the
+    MongoDB of docker-compose, run them in the web container:
+
+        docker-compose exec web python -m unittest discover tests
+"""
+
+import os
+import re
+import secrets
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class DetectTokensTest(unittest.TestCase):
+    def setUp(self):
+        app.app.testing = True
+        self.client = app.app.test_client()
+        self.username = f"test-{secrets.token_hex(4)}"
+        self.post("/register", {"username": self.username, "password": "pw"})
+        self.post("/refill", {"username": self.username, "admin_pw": "abc123", "refill": 10})
+        self.tokens = self.balance()
+
+    def post(self, path, body):
+        return self.client.post(path, json=body).get_json()
+
+    def balance(self):
+        retJson = self.post("/refill", {"username": self.username, "admin_pw": "abc123", "refill": 0})
+        return int(re.search(r"now have (-?\d+) tokens", retJson["msg"]).group(1))
+
+    def test_texts_that_are_not_strings_charge_nothing(self):
+        retJson = self.post("/detect", {"username": self.username, "password": "pw", "text1": "a", "text2": 5})
+        self.assertEqual(retJson["status"], 303)
+        retJson = self.post("/detectBatch", {"username": self.username, "password": "pw",
+                                             "text1": "a", "candidates": ["b", 7]})
+        self.assertEqual(retJson["status"], 303)
+        retJson = self.post("/detectBatch", {"username": self.username, "password": "pw",
+                                             "text1": "a", "candidates": 7})
+        self.assertEqual(retJson["status"], 303)
+        self.assertEqual(self.balance(), self.tokens)
+
+    def test_failed_scores_are_refunded(self):
+        with mock.patch.object(app, "textVectors", side_effect=RuntimeError("pipeline failed")):
+            with self.assertRaises(RuntimeError):
+                self.post("/detect", {"username": self.username, "password": "pw", "text1": "a", "text2": "b"})
+            with self.assertRaises(RuntimeError):
+                self.post("/detectBatch", {"username": self.username, "password": "pw",
+                                           "text1": "a", "candidates": ["b", "c"]})
+        self.assertEqual(self.balance(), self.tokens)
+
+    def test_scores_are_charged(self):
+        retJson = self.post("/detectBatch", {"username": self.username, "password": "pw",
+                                             "text1": "a", "candidates": ["b", "c"]})
+        self.assertEqual(retJson["status"], 200)
+        self.assertEqual(self.balance(), self.tokens - 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
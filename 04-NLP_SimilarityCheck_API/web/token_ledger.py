@@ -0,0 +1,51 @@
+"""
+    Token accounting of the API: every charge and every refill is a single
+    atomic update of the user document
+"""
+
+from pymongo import ReturnDocument
+
+
+class TokenLedger:
+    """
+        Charges and refills the Tokens of the users collection. The balance is
+        checked and changed by MongoDB in the same update, so concurrent
+        requests of one user can't spend the same token twice and each
+        operation costs one round trip
+    """
+    def __init__(self, users):
+        self.users = users
+
+    def charge(self, username, amount=1, setFields=None, projection=None):
+        """
+            Takes amount tokens away if the user has at least that many. The fields of
+            setFields are written by the same update. Return the user document after the
+            charge, with Tokens and the fields of projection, or None, without charging
+            anything, if the user doesn't exist or has less than amount tokens
+        """
+        update = {"$inc": {"Tokens": -amount}}
+        if setFields:
+            update["$set"] = setFields
+
+        fields = {"_id": 0, "Tokens": 1}
+        fields.update(projection or {})
+
+        return self.users.find_one_and_update(
+            {"Username": username, "Tokens": {"$gte": amount}},
+            update,
+            projection=fields,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def refill(self, username, amount):
+        """
+            Adds amount tokens, also used to give back the tokens of a failed call.
+            Return the new balance, or None if the user doesn't exist
+        """
+        user = self.users.find_one_and_update(
+            {"Username": username},
+            {"$inc": {"Tokens": amount}},
+            projection={"_id": 0, "Tokens": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return None if user is None else user["Tokens"]
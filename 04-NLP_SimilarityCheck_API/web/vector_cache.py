@@ -0,0 +1,107 @@
+"""
+    Cache of document vectors keyed by a hash of the normalized text
+"""
+
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy
+from bson.binary import Binary
+
+
+def normalizeText(text):
+    """
+        Canonical form of a text: NFC unicode and no surrounding whitespace
+    """
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def textKey(modelName, text):
+    """
+        Cache key of a normalized text. The model name is part of the key so a
+        hot-swapped model never reads vectors computed by the previous one
+    """
+    return hashlib.sha256(f"{modelName}\0{text}".encode("utf8")).hexdigest()
+
+
+class VectorCache:
+    """
+        Bounded in-memory LRU of document vectors, evicting the least recently
+        used vectors once they take more than maxBytes. When a collection is
+        given, vectors are also persisted in MongoDB and shared by every worker
+    """
+    def __init__(self, collection=None, maxBytes=64 * 1024 * 1024):
+        self.collection = collection
+        self.maxBytes = maxBytes
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.bytesUsed = 0
+        self.memoryHits = 0
+        self.dbHits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+            Returns the cached vector of a key or None
+        """
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memoryHits += 1
+                return vector
+
+        doc = self.collection.find_one({"_id": key}) if self.collection is not None else None
+        with self.lock:
+            if doc is None:
+                self.misses += 1
+                return None
+            self.dbHits += 1
+            vector = numpy.frombuffer(doc["Vector"], dtype=numpy.float32)
+            self.remember(key, vector)
+            return vector
+
+    def put(self, key, vector):
+        """
+            Stores a vector in memory and, if enabled, in MongoDB
+        """
+        vector = numpy.ascontiguousarray(vector, dtype=numpy.float32)
+        with self.lock:
+            self.remember(key, vector)
+
+        if self.collection is not None:
+            self.collection.replace_one({"_id": key}, {
+                "_id": key,
+                "Vector": Binary(vector.tobytes())
+            }, upsert=True)
+
+    def remember(self, key, vector):
+        """
+            Adds a vector to the memory tier, the caller holds the lock
+        """
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.bytesUsed -= previous.nbytes
+        self.memory[key] = vector
+        self.bytesUsed += vector.nbytes
+        while self.bytesUsed > self.maxBytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.bytesUsed -= evicted.nbytes
+
+    def stats(self):
+        """
+            Hit ratio and memory used by the cache
+        """
+        with self.lock:
+            lookups = self.memoryHits + self.dbHits + self.misses
+            return {
+                "memoryHits": self.memoryHits,
+                "dbHits": self.dbHits,
+                "misses": self.misses,
+                "hitRatio": (self.memoryHits + self.dbHits) / lookups if lookups else 0,
+                "entries": len(self.memory),
+                "bytesUsed": self.bytesUsed
+            }
@@ -2,23 +2,48 @@
     API for image Classification
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g
 from flask_restful import Api, Resource
-from pymongo import MongoClient
-import bcrypt
-import requests
-import subprocess
-import json
+from pymongo import MongoClient, monitoring
+from pymongo.errors import DuplicateKeyError
+import base64
+import binascii
+import os
 import numpy
 import tensorflow
+from classify_image import ImageClassifier, maybe_download_and_extract
+from batching import BatchScheduler
+from result_cache import ResultCache, imageDigest
+from image_fetcher import ImageFetcher, FetchError
+from auth import checkPassword, hashPassword, SessionTokens, bearerToken, cryptoExecutor
+from token_ledger import TokenLedger
 
 app = Flask(__name__)
 api = Api(app)
 
+class CommandCounter(monitoring.CommandListener):
+    """
+        Counts the commands sent to MongoDB, tests read mongoOps.count, or the mongoOps of
+        /metrics, before and after a call to know how many round trips an endpoint makes
+    """
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongoOps = CommandCounter()
+
 # When the mongoDB client is created //db must be the same name defined in the file 
 # Default mongoDB port is 27017
 # docker-compose.yml for the mongoDB container
-client = MongoClient("mongodb://db:27017")
+client = MongoClient("mongodb://db:27017", event_listeners=[mongoOps])
 
 #Step 1: create a DB
 db = client.ClassifyDB
@@ -26,6 +51,59 @@ db = client.ClassifyDB
 # Step 2: create collections
 users = db["Users"]
 
+# Fields of the user document the API reads
+USER_FIELDS = {"_id": 0, "Username": 1, "Password": 1, "Tokens": 1}
+
+# Tokens are charged and refilled with atomic updates
+tokenLedger = TokenLedger(users)
+
+# Signed session tokens, revoked ones are tracked in RevokedTokens
+sessions = SessionTokens(db["RevokedTokens"])
+
+# Start the bcrypt worker processes before the web server starts its threads
+cryptoExecutor.warmUp()
+
+# Step 3: load the Inception model once per worker. The graph, the tf.Session
+# and the node lookup stay in memory and serve every /classify call
+MODEL_DIR = "."
+maybe_download_and_extract(MODEL_DIR)
+classifier = ImageClassifier(MODEL_DIR)
+
+# Step 4: concurrent /classify calls are grouped in micro-batches of up to
+# MAX_BATCH_SIZE images, waiting at most MAX_BATCH_WAIT_MS for a batch to fill
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))
+MAX_BATCH_WAIT_MS = int(os.environ.get("MAX_BATCH_WAIT_MS", 10))
+scheduler = BatchScheduler(classifier, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS)
+
+# /classifyBatch accepts up to MAX_BATCH_ITEMS images per call
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 64))
+
+# Step 5: results are cached by the SHA-256 of the image, in memory and in the
+# ClassifyCache collection. UrlCache keeps the ETag/Last-Modified of each URL
+resultCache = ResultCache(db["ClassifyCache"], db["UrlCache"],
+                          maxEntries=int(os.environ.get("CACHE_MAX_ENTRIES", 1024)),
+                          maxDbEntries=int(os.environ.get("CACHE_MAX_DB_ENTRIES", 100000)),
+                          ttlSeconds=int(os.environ.get("CACHE_TTL_SECONDS", 86400)))
+
+# Step 6: images are downloaded through pooled keep-alive connections, with a
+# byte cap and connect/read deadlines
+fetcher = ImageFetcher(maxBytes=int(os.environ.get("FETCH_MAX_BYTES", 10 * 1024 * 1024)),
+                       connectTimeout=float(os.environ.get("FETCH_CONNECT_TIMEOUT", 3.05)),
+                       readTimeout=float(os.environ.get("FETCH_READ_TIMEOUT", 10)),
+                       deadline=float(os.environ.get("FETCH_DEADLINE", 30)))
+
+def createIndexes():
+    """
+        Creates the indexes the queries of the API need. create_index does nothing when
+        the index already exists, so every worker runs it at start
+    """
+    # Every query looks users up by Username, unique so /register can't create duplicates
+    users.create_index("Username", unique=True)
+    sessions.createIndexes()
+    resultCache.createIndexes()
+
+createIndexes()
+
 """ 
 ****************************AUXILIAR FUNTCIONS***********************************
 """
@@ -36,68 +114,116 @@ def genJson(errCode, errMsg):
     }
     return retJson     
 
+def loadUser(username):
+    """
+        Auxiliar function that returns the document of a user, or None. The document is read
+        once per request, with only the fields listed in USER_FIELDS, and every helper
+        reuses it. Helpers that write the user document call invalidateUser
+    """
+    loaded = g.setdefault("users", {})
+    if username not in loaded:
+        loaded[username] = users.find_one({"Username": username}, USER_FIELDS)
+    return loaded[username]
+
+def invalidateUser(username):
+    """
+        Auxiliar function that drops the memoized document of a user after a write
+    """
+    g.get("users", {}).pop(username, None)
+
 def userExist(username):
     """
         Auxiliar function to check if a username already exists in the DB.
         Return True if exists, otherwise returns False
     """
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    return users.find(SELECTION_CRITERIA).count() > 0
+    return loadUser(username) is not None
 
-def verifyCredentials(username,password):
+def verifyPassword(username,password):
     """
-        Auxiliar function to verify the credentials of username and password. 
-        Return True or False
+        Auxiliar function to verify the credentials of username and password, ignoring
+        any bearer token. Return the error JSON and False, or None and True
     """
     if not userExist(username):
         errJson = genJson(301, f"Invalid username. User {username} already exists")
         return errJson, False
 
-    hashed_pw = users.find({"Username": username})[0]["Password"]
-    if bcrypt.hashpw(password.encode('utf8'),hashed_pw) != hashed_pw:
+    hashed_pw = loadUser(username)["Password"]
+    if password is None or not checkPassword(username, password, hashed_pw):
         errJson = genJson(302, f"Invalid password for User {username}")
         return errJson, False
     
     return None, True
 
+def verifyCredentials(username,password):
+    """
+        Auxiliar function to verify the credentials of username and password. 
+        Return True or False. A bearer token in the request replaces the password
+    """
+    token = bearerToken()
+    if token is not None:
+        if sessions.verify(token) != username:
+            errJson = genJson(302, f"Invalid or expired session token for User {username}")
+            return errJson, False
+        return None, True
+
+    return verifyPassword(username, password)
+
 def getTokens(username):
     """
         Auxiliar function returns number of tokens a username have
     """
-    tokens = users.find({"Username": username})[0]["Tokens"]
+    tokens = loadUser(username)["Tokens"]
     return tokens
 
-def takeOneToken(username):
+def takeTokens(username, amount=1):
     """
-        Auxiliar function that update the DB taking one token away from the username
+        Auxiliar function that takes amount tokens away in a single atomic update.
+        Return False, without charging anything, if the user has less than amount tokens
     """
-    tokens = getTokens(username)
-        
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Tokens": tokens - 1
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    invalidateUser(username)
+    return tokenLedger.charge(username, amount) is not None
 
 def refillTokens(username, tokensAumount):
     """
-        Auxiliar function to refill the number of tokens of a specific user
+        Auxiliar function to refill the number of tokens of a specific user, atomically.
+        Return the new amount of tokens
     """
-    tokens = getTokens(username) + tokensAumount
-        
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Tokens": tokens
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    invalidateUser(username)
+    return tokenLedger.refill(username, tokensAumount)
 
-    return tokens
+def downloadImage(imageUrl):
+    """
+        Auxiliar function that downloads an image, revalidating URLs seen before with a
+        conditional GET. Return the image digest, the cached predictions (None on a cache
+        miss) and the image bytes (None if the server answered 304). Raise FetchError
+    """
+    headers, digest = resultCache.validators(imageUrl)
+    r = fetcher.fetch(imageUrl, headers)
+    if r.status_code == 304:
+        retJson = resultCache.get(digest)
+        if retJson is not None:
+            resultCache.markRevalidated()
+            return digest, retJson, None
+        r = fetcher.fetch(imageUrl)
+
+    digest = imageDigest(r.content)
+    resultCache.putUrl(imageUrl, r.headers.get("ETag"), r.headers.get("Last-Modified"), digest)
+    return digest, resultCache.get(digest), r.content
+
+def decodeBase64Image(data):
+    """
+        Auxiliar function that decodes a base64 image. Return the image digest, the cached
+        predictions (None on a cache miss) and the image bytes. Raise ValueError
+    """
+    try:
+        content = base64.b64decode(data, validate=True)
+    except (binascii.Error, TypeError):
+        raise ValueError("The image is not valid base64")
+    if len(content) > fetcher.maxBytes:
+        raise ValueError(f"The image is bigger than {fetcher.maxBytes} bytes")
+
+    digest = imageDigest(content)
+    return digest, resultCache.get(digest), content
 
 def verifyTokens(username):
     errCode = 303
@@ -133,26 +259,26 @@ class Register(Resource):
         username = postedData["username"]
         password = postedData["password"]
 
-        # Step 3: Check if user already exists
-        if userExist(username):
+        # Step 3: Hash the password with bcrypt, on the crypto pool
+        hashed_pw = hashPassword(password)
+
+        # Step 4: Store the username, password and the amount of tokens into the DB
+        # The unique index on Username rejects a user that already exists
+        tokens = 6
+        try:
+            users.insert_one({
+                "Username": username,
+                "Password": hashed_pw,
+                "Tokens": tokens
+
+            })
+        except DuplicateKeyError:
             retJson = {
                 "status": 301,
                 "msg": f"Invalid username. User {username} already exists"
             }
             return jsonify(retJson)
 
-        # Step 4: Hash the password with bcrypt
-        hashed_pw = bcrypt.hashpw(password.encode('utf8'),bcrypt.gensalt())
-
-        # Step 4: Store the username, password and the amount of tokens into the DB
-        tokens = 6
-        users.insert({
-            "Username": username,
-            "Password": hashed_pw,
-            "Tokens": tokens
-
-        })
-
         # Step 5: Return message to the user
         retJson = {
             "status": 200,
@@ -161,6 +287,49 @@ class Register(Resource):
 
         return jsonify(retJson)
 
+class Login(Resource):
+    """
+        Class to open a session
+    """
+    def post(self):
+        """
+            POST Function that exchanges the username and password for a bearer token.
+            The other resources accept the header "Authorization: Bearer <token>"
+            instead of the password until the token expires
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData["password"]
+
+        # Step 3: Verify credentials. A token can't open a new session, the
+        # password is always required
+        retJson, validCredentials = verifyPassword(username,password)
+        if not validCredentials:
+            return jsonify(retJson)
+
+        # Step 4: Issue the token
+        retJson = genJson(200, "Session opened")
+        retJson["token"] = sessions.issue(username)
+        retJson["expiresIn"] = sessions.ttl
+        return jsonify(retJson)
+
+class Logout(Resource):
+    """
+        Class to close a session
+    """
+    def post(self):
+        """
+            POST Function that revokes the bearer token of the request
+        """
+        token = bearerToken()
+        if token is None or not sessions.revoke(token):
+            return jsonify(genJson(302, "Invalid session token"))
+
+        return jsonify(genJson(200, "Session closed"))
+
 class Classify(Resource):
     """
         Class to detect classify an image
@@ -174,7 +343,7 @@ class Classify(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         imageUrl = postedData["url"]
 
         # Step 3: Verify credentials
@@ -182,27 +351,110 @@ class Classify(Resource):
         if not validCredentials:
             return jsonify(retJson)
 
-        # Step 5: Verify user has enough tokens
+        # Step 5: Take one token away, nothing is charged if the user has no tokens left.
+        # A call that fails gets its token back
+        if not takeTokens(username):
+            return jsonify(genJson(303, "You are out of tokens, please refill"))
+
+        # Step 6: Download the image of the URL in Python and genereta the JSON prediction
+        try:
+            digest, retJson, content = downloadImage(imageUrl)
+        except FetchError as e:
+            refillTokens(username, 1)
+            return jsonify(genJson(306, str(e)))
+
+        if retJson is None:
+            # Step 6.1: Classify the image on a cache miss, the scheduler batches it
+            # with any other request arriving at the same time
+            try:
+                retJson = scheduler.classify(content)
+            except tensorflow.errors.InvalidArgumentError:
+                refillTokens(username, 1)
+                return jsonify(genJson(305, "The URL does not point to a valid JPEG image"))
+            resultCache.put(digest, retJson)
+
+        # Step 7: Return 200 OK
+        return jsonify(retJson)
+
+class ClassifyBatch(Resource):
+    """
+        Class to classify many images in one call
+    """
+    def post(self):
+        """
+            POST Function that handles the classification of a list of image URLs and/or
+            base64 encoded images. Every image that could be downloaded and decoded costs
+            one token, charged for the whole batch in a single atomic update
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData.get("password")
+        imageUrls = postedData.get("urls", [])
+        images = postedData.get("images", [])
+
+        if len(imageUrls) + len(images) > MAX_BATCH_ITEMS:
+            return jsonify(genJson(307, f"A batch can't have more than {MAX_BATCH_ITEMS} images"))
+
+        # Step 3: Verify credentials
+        retJson, validCredentials = verifyCredentials(username,password)
+        if not validCredentials:
+            return jsonify(retJson)
+
+        # Step 4: Verify user has enough tokens
         retJson, haveTokens = verifyTokens(username)
         if not haveTokens:
             return jsonify(retJson)
 
-        # Step 6: Download the image of the URL in Python and genereta the JSON prediction
-        retJson = {}
-        r = requests.get(imageUrl)
-        with open("temp.jpg","wb") as f:
-            f.write(r.content)
-            # Step 6.1: Open a Python subprocess to classify the image
-            proc = subprocess.Popen('python classify_image.py --model_dir=. --image_file=temp.jpg', shell=True)
-            proc.communicate()[0]
-            proc.wait()
-            with open("text.txt") as g:
-                retJson = json.load(g)
-
-        # Step 7: Take one token away and return 200 OK
-        takeOneToken(username)
-        
-        return jsonify(retJson)
+        # Step 5: Download every URL concurrently and decode the base64 images
+        items = [{"url": imageUrl} for imageUrl in imageUrls] + [{"image": i} for i in range(len(images))]
+        downloads = [fetcher.executor.submit(downloadImage, imageUrl) for imageUrl in imageUrls]
+        for item, download in zip(items, downloads):
+            try:
+                item["digest"], item["predictions"], item["content"] = download.result()
+            except FetchError as e:
+                item.update(genJson(306, str(e)))
+        for item, data in zip(items[len(imageUrls):], images):
+            try:
+                item["digest"], item["predictions"], item["content"] = decodeBase64Image(data)
+            except ValueError as e:
+                item.update(genJson(305, str(e)))
+
+        # Step 6: Decode the images that missed the cache
+        for item in items:
+            if "status" not in item and item["predictions"] is None:
+                try:
+                    item["tensor"] = classifier.preprocess(item["content"])
+                except tensorflow.errors.InvalidArgumentError:
+                    item.update(genJson(305, "Not a valid JPEG image"))
+
+        # Step 7: Charge one token per valid image in a single atomic update
+        valid = [item for item in items if "status" not in item]
+        if valid and not takeTokens(username, len(valid)):
+            return jsonify(genJson(303, f"You need {len(valid)} tokens for this batch, please refill"))
+
+        # Step 8: Queue every miss at once so the scheduler runs them as batched passes
+        for item in valid:
+            if "tensor" in item:
+                item["future"] = scheduler.enqueue(item.pop("tensor"))
+        for item in valid:
+            if "future" in item:
+                item["predictions"] = item.pop("future").result()
+                resultCache.put(item["digest"], item["predictions"])
+            item["status"] = 200
+
+        # Step 9: Return the per image results
+        for item in items:
+            item.pop("digest", None)
+            item.pop("content", None)
+
+        return jsonify({
+            "status": 200,
+            "tokensCharged": len(valid),
+            "results": items
+        })
 
 class Refill(Resource):
     """
@@ -234,6 +486,21 @@ class Refill(Resource):
 
         return jsonify(genJson(200, f"Tokens Refill successful. User {username} now have {amount} tokens"))
 
+class Metrics(Resource):
+    """
+        Inference metrics of this worker
+    """
+    def get(self):
+        """
+            GET Function that returns the batching queue and cache metrics
+        """
+        return jsonify({
+            "batching": scheduler.stats(),
+            "cache": resultCache.stats(),
+            "crypto": cryptoExecutor.stats(),
+            "mongoOps": mongoOps.count
+        })
+
 """ 
 ********************end API Resources Class definition****************************
 """
@@ -243,8 +510,12 @@ class Refill(Resource):
 ********************Adding the resources to the API****************************
 """
 api.add_resource(Register,'/register')
+api.add_resource(Login,'/login')
+api.add_resource(Logout,'/logout')
 api.add_resource(Classify,'/classify')
+api.add_resource(ClassifyBatch,'/classifyBatch')
 api.add_resource(Refill,'/refill')
+api.add_resource(Metrics,'/metrics')
 """ 
 ****************end Adding the resources to the API****************************
 """
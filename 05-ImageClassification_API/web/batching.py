@@ -0,0 +1,107 @@
+"""
+    Dynamic micro-batching scheduler in front of the Inception session
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy
+
+
+class BatchScheduler:
+    """
+        Collects concurrent classification requests and runs them through the
+        model as one batch. A batch is dispatched as soon as it holds
+        maxBatchSize images or the oldest request waited maxWaitMs
+    """
+    def __init__(self, classifier, maxBatchSize=32, maxWaitMs=10):
+        self.classifier = classifier
+        self.maxBatchSize = maxBatchSize
+        self.maxWait = maxWaitMs / 1000.0
+        self.pending = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.maxQueueDepth = 0
+        self.batchSizes = {}
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image_data):
+        """
+            Queue one JPEG for classification. Returns a Future with the top k
+            predictions. Decoding happens here, in the caller thread, so the
+            worker only spends its time on the network itself
+        """
+        return self.enqueue(self.classifier.preprocess(image_data))
+
+    def enqueue(self, image):
+        """
+            Queue an image already decoded by classifier.preprocess
+        """
+        future = Future()
+        self.pending.put((image, future))
+
+        depth = self.pending.qsize()
+        with self.lock:
+            self.maxQueueDepth = max(self.maxQueueDepth, depth)
+        return future
+
+    def classify(self, image_data, timeout=None):
+        """
+            Blocking helper, returns the top k predictions of one JPEG
+        """
+        return self.submit(image_data).result(timeout)
+
+    def run(self):
+        """
+            Worker loop: wait for a first request, then keep collecting until
+            the batch is full or its deadline passes
+        """
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.maxWait
+            while len(batch) < self.maxBatchSize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.runBatch(batch)
+
+    def runBatch(self, batch):
+        futures = [future for _, future in batch]
+        try:
+            results = self.classifier.predict(numpy.concatenate([image for image, _ in batch]))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self.lock:
+            self.batches += 1
+            self.images += len(batch)
+            self.batchSizes[len(batch)] = self.batchSizes.get(len(batch), 0) + 1
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def stats(self):
+        """
+            Queue depth and batch size metrics
+        """
+        with self.lock:
+            return {
+                "queueDepth": self.pending.qsize(),
+                "maxQueueDepth": self.maxQueueDepth,
+                "batches": self.batches,
+                "images": self.images,
+                "avgBatchSize": self.images / self.batches if self.batches else 0,
+                "batchSizes": {str(size): count for size, count in sorted(self.batchSizes.items())}
+            }
@@ -0,0 +1,73 @@
+"""
+    Compares the two ways /classify has run Inception: a new
+    classify_image.py process per image, which loads the graph every time,
+    and the resident ImageClassifier the API builds once at startup. Run it
+    in the web container, where the model is already downloaded:
+
+        docker-compose exec web python bench/classify_latency.py
+
+    The resident model pays its startup once, the subprocess pays it on
+    every call
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classify_image import ImageClassifier, maybe_download_and_extract
+
+
+def summary(name, seconds):
+    seconds = sorted(seconds)
+    p95 = seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))]
+    print(f"{name:<22}{statistics.median(seconds) * 1000:>10.1f}{p95 * 1000:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-dir", default=".")
+    parser.add_argument("--image-file", help="JPEG to classify, the panda of the model by default")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--subprocess-requests", type=int, default=5)
+    args = parser.parse_args()
+
+    maybe_download_and_extract(args.model_dir)
+    imageFile = args.image_file or os.path.join(args.model_dir, "cropped_panda.jpg")
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "classify_image.py")
+
+    # Step 1: the old /classify, one process per image
+    perProcess = []
+    for _ in range(args.subprocess_requests):
+        start = time.monotonic()
+        subprocess.run([sys.executable, script, f"--model_dir={args.model_dir}", f"--image_file={imageFile}"],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        perProcess.append(time.monotonic() - start)
+
+    # Step 2: the resident model, built once
+    start = time.monotonic()
+    classifier = ImageClassifier(args.model_dir)
+    startup = time.monotonic() - start
+
+    with open(imageFile, "rb") as f:
+        content = f.read()
+    classifier.classify(content)
+    resident = []
+    for _ in range(args.requests):
+        start = time.monotonic()
+        classifier.classify(content)
+        resident.append(time.monotonic() - start)
+    classifier.close()
+
+    print(f"resident startup      {startup * 1000:.1f} ms")
+    print(f"{'per request':<22}{'p50 ms':>10}{'p95 ms':>10}")
+    summary("subprocess", perProcess)
+    summary("resident", resident)
+    print(f"speedup (p50)         {statistics.median(perProcess) / statistics.median(resident):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
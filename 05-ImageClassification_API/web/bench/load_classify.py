@@ -0,0 +1,119 @@
+"""
+    Load test of /classify at several concurrency levels, with the
+    micro-batching metrics of /metrics for each one. The script serves the
+    image itself and appends a name unique to each request to the JPEG, so
+    every call misses the result cache and reaches the model. Run it in the
+    web container, where the API can download from localhost:
+
+        docker-compose exec web python bench/load_classify.py
+
+    The batching figures come from the counters of the worker, they are
+    exact only if nothing else uses the API meanwhile
+"""
+
+import argparse
+import http.server
+import json
+import os
+import secrets
+import socketserver
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ADMIN_PW = "abc123"
+
+
+class ImageServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serveImage(content, port):
+    """
+        Serves content followed by the name in the path, e.g. 17.jpg, from a thread
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = content + os.path.basename(self.path).encode('utf8')
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ImageServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def call(base, method, path, body=None, token=None):
+    data = None if body is None else json.dumps(body).encode('utf8')
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    request = urllib.request.Request(base + path, data=data, method=method, headers=headers)
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return json.loads(response.read())
+
+def runLevel(args, username, token, clients, prefix):
+    """
+        Sends args.requests /classify calls from clients threads. Return the latencies,
+        the seconds it took and the batching counters before and after
+    """
+    def classify(n):
+        start = time.monotonic()
+        retJson = call(args.url, "POST", "/classify", {
+            "username": username,
+            "url": f"http://{args.image_host}:{args.image_port}/{prefix}-{n}.jpg"
+        }, token)
+        if "status" in retJson:
+            raise RuntimeError(f"/classify failed: {retJson}")
+        return time.monotonic() - start
+
+    before = call(args.url, "GET", "/metrics")["batching"]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = list(executor.map(classify, range(args.requests)))
+    seconds = time.monotonic() - start
+    after = call(args.url, "GET", "/metrics")["batching"]
+    return latencies, seconds, before, after
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--image-file", default="cropped_panda.jpg")
+    parser.add_argument("--image-host", default="localhost", help="host name the API downloads the image from")
+    parser.add_argument("--image-port", type=int, default=8090)
+    parser.add_argument("--clients", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=128, help="calls per concurrency level")
+    args = parser.parse_args()
+    levels = [int(clients) for clients in args.clients.split(",")]
+
+    with open(args.image_file, "rb") as f:
+        serveImage(f.read(), args.image_port)
+
+    run = secrets.token_hex(4)
+    username = f"load-{run}"
+    call(args.url, "POST", "/register", {"username": username, "password": "pw"})
+    call(args.url, "POST", "/refill", {"username": username, "admin_pw": ADMIN_PW,
+                                       "refill": args.requests * len(levels)})
+    token = call(args.url, "POST", "/login", {"username": username, "password": "pw"})["token"]
+
+    print(f"{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'batches':>10}{'avg batch':>11}{'max queue':>11}")
+    for i, clients in enumerate(levels):
+        latencies, seconds, before, after = runLevel(args, username, token, clients, f"{run}-{i}")
+        latencies.sort()
+        batches = after["batches"] - before["batches"]
+        images = after["images"] - before["images"]
+        print(f"{clients:>8}{args.requests / seconds:>10.1f}"
+              f"{statistics.median(latencies) * 1000:>10.1f}"
+              f"{latencies[int(len(latencies) * 0.95)] * 1000:>10.1f}"
+              f"{batches:>10}{images / batches if batches else 0:>11.2f}{after['maxQueueDepth']:>11}")
+
+
+if __name__ == "__main__":
+    main()
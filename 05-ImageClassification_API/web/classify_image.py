@@ -111,62 +111,131 @@ class NodeLookup(object):
     return self.node_lookup[node_id]
 
 
-def create_graph():
-  """Creates a graph from saved GraphDef file and returns a saver."""
+def create_graph(model_dir=None):
+  """Creates a graph from saved GraphDef file and returns the GraphDef."""
+  if not model_dir:
+    model_dir = FLAGS.model_dir
   # Creates graph from saved graph_def.pb.
   with tf.gfile.FastGFile(os.path.join(
-      FLAGS.model_dir, 'classify_image_graph_def.pb'), 'rb') as f:
+      model_dir, 'classify_image_graph_def.pb'), 'rb') as f:
     graph_def = tf.GraphDef()
     graph_def.ParseFromString(f.read())
     _ = tf.import_graph_def(graph_def, name='')
+  return graph_def
 
 
-def run_inference_on_image(image):
-  """Runs inference on an image.
-  Args:
-    image: Image file name.
-  Returns:
-    Nothing
+class ImageClassifier(object):
+  """Keeps the Inception graph, session and node lookup resident in memory.
+
+  create_graph() and NodeLookup() cost seconds on every call, so a long-lived
+  process (e.g. the web API) builds one ImageClassifier at startup and serves
+  every image from it.
   """
-  if not tf.gfile.Exists(image):
-    tf.logging.fatal('File does not exist %s', image)
-  image_data = tf.gfile.FastGFile(image, 'rb').read()
 
-  # Creates graph from saved GraphDef.
-  create_graph()
+  def __init__(self, model_dir, num_top_predictions=5):
+    self.num_top_predictions = num_top_predictions
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      graph_def = create_graph(model_dir)
+      self._build_batch_graph(graph_def)
+    # tf.Session.run is thread safe, one session serves every request.
+    self.sess = tf.Session(graph=self.graph)
+    self.softmax_tensor = self.graph.get_tensor_by_name('softmax:0')
+    self.node_lookup = NodeLookup(
+        os.path.join(model_dir, 'imagenet_2012_challenge_label_map_proto.pbtxt'),
+        os.path.join(model_dir, 'imagenet_synset_to_human_label_map.txt'))
+
+  def _build_batch_graph(self, graph_def):
+    """Adds a batched copy of the network next to the single image one.
+
+    The stock graph decodes one JPEG and reshapes pool_3 to a single row
+    before the softmax, so it can't take a batch. Here each JPEG is decoded
+    and resized on its own (the same DecodeJpeg -> ResizeBilinear -> Sub ->
+    Mul steps the graph does), the graph is re-imported with 'Mul:0' mapped
+    to a [None, 299, 299, 3] placeholder, and the softmax layer is applied
+    to the batched pool_3 output using the graph's own weights.
+    """
+    self.jpeg_data = tf.placeholder(tf.string, name='batch_jpeg')
+    image = tf.image.decode_jpeg(self.jpeg_data, channels=3)
+    image = tf.expand_dims(tf.cast(image, tf.float32), 0)
+    image = tf.image.resize_bilinear(image, [299, 299])
+    self.preprocessed = (image - 128.0) / 128.0
+
+    self.batch_input = tf.placeholder(
+        tf.float32, [None, 299, 299, 3], name='batch_input')
+    pool_3, = tf.import_graph_def(graph_def,
+                                  input_map={'Mul:0': self.batch_input},
+                                  return_elements=['pool_3:0'],
+                                  name='batch')
+    weights = self.graph.get_tensor_by_name('softmax/weights:0')
+    biases = self.graph.get_tensor_by_name('softmax/biases:0')
+    logits = tf.matmul(tf.reshape(pool_3, [-1, 2048]), weights) + biases
+    self.batch_softmax = tf.nn.softmax(logits)
+
+  def preprocess(self, image_data):
+    """Decodes and resizes a JPEG into a [1, 299, 299, 3] input array."""
+    return self.sess.run(self.preprocessed, {self.jpeg_data: image_data})
+
+  def predict(self, images):
+    """Runs a [N, 299, 299, 3] batch and returns one top k dict per image."""
+    predictions = self.sess.run(self.batch_softmax,
+                                {self.batch_input: images})
+    return [self.top_predictions(row) for row in predictions]
+
+  def top_predictions(self, predictions):
+    """Maps a softmax vector to {human_string: str(score)} for the top k."""
+    top_k = predictions.argsort()[-self.num_top_predictions:][::-1]
+    retJson = dict()
+    for node_id in top_k:
+      human_string = self.node_lookup.id_to_string(node_id)
+      retJson[human_string] = str(predictions[node_id])
+    return retJson
+
+  def classify_file(self, image):
+    """Runs inference on an image file and returns the top k predictions."""
+    if not tf.gfile.Exists(image):
+      tf.logging.fatal('File does not exist %s', image)
+    return self.classify(tf.gfile.FastGFile(image, 'rb').read())
+
+  def classify(self, image_data):
+    """Runs inference on the JPEG bytes of an image, nothing touches disk.
 
-  with tf.Session() as sess:
-    # Some useful tensors:
+    Args:
+      image_data: JPEG encoded image, e.g. the body of an HTTP response.
+    Returns:
+      dict from human readable label to score for the top k predictions.
+    """
     # 'softmax:0': A tensor containing the normalized prediction across
     #   1000 labels.
-    # 'pool_3:0': A tensor containing the next-to-last layer containing 2048
-    #   float description of the image.
     # 'DecodeJpeg/contents:0': A tensor containing a string providing JPEG
     #   encoding of the image.
-    # Runs the softmax tensor by feeding the image_data as input to the graph.
-    softmax_tensor = sess.graph.get_tensor_by_name('softmax:0')
-    predictions = sess.run(softmax_tensor,
-                           {'DecodeJpeg/contents:0': image_data})
-    predictions = np.squeeze(predictions)
+    predictions = self.sess.run(self.softmax_tensor,
+                                {'DecodeJpeg/contents:0': image_data})
+    return self.top_predictions(np.squeeze(predictions))
 
-    # Creates node ID --> English string lookup.
-    node_lookup = NodeLookup()
+  def close(self):
+    self.sess.close()
 
-    top_k = predictions.argsort()[-FLAGS.num_top_predictions:][::-1]
-    retJson = dict()
-    for node_id in top_k:
-      human_string = node_lookup.id_to_string(node_id)
-      score = predictions[node_id]
-      retJson[human_string]= str(score)
-      print('%s (score = %.5f)' % (human_string, score))
-    print(retJson)
-    with open("text.txt", 'w') as f:
-      json.dump(retJson, f)
+
+def run_inference_on_image(image):
+  """Runs inference on an image.
+  Args:
+    image: Image file name.
+  Returns:
+    Nothing
+  """
+  classifier = ImageClassifier(FLAGS.model_dir, FLAGS.num_top_predictions)
+  retJson = classifier.classify_file(image)
+  classifier.close()
+
+  for human_string, score in retJson.items():
+    print('%s (score = %.5f)' % (human_string, float(score)))
+  print(json.dumps(retJson))
 
 
-def maybe_download_and_extract():
+def maybe_download_and_extract(model_dir=None):
   """Download and extract model tar file."""
-  dest_directory = FLAGS.model_dir
+  dest_directory = model_dir if model_dir else FLAGS.model_dir
   if not os.path.exists(dest_directory):
     os.makedirs(dest_directory)
   filename = DATA_URL.split('/')[-1]
@@ -221,4 +290,4 @@ if __name__ == '__main__':
       help='Display this many predictions.'
   )
   FLAGS, unparsed = parser.parse_known_args()
-tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
+  tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,137 @@
+"""
+    Image download layer of the classification API
+"""
+
+import logging
+import socket
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Same attribute names as requests.Response, so callers read both alike
+FetchedImage = namedtuple("FetchedImage", ["status_code", "content", "headers"])
+
+
+class FetchError(Exception):
+    """
+        Raised when an image can't be downloaded: connection errors, timeouts,
+        non 200 answers and bodies bigger than the byte cap
+    """
+
+
+class ImageFetcher:
+    """
+        Downloads images through a pooled requests.Session. Keep-alive
+        connections are reused per host, bodies are streamed and abandoned as
+        soon as they go over maxBytes, and every download is bounded by a
+        connect timeout, a read timeout and an overall deadline.
+
+        fetch() is the blocking call. submit() and fetchMany() run downloads
+        on a thread pool so many of them overlap with each other and with
+        inference.
+    """
+    def __init__(self, maxBytes=10 * 1024 * 1024, connectTimeout=3.05, readTimeout=10,
+                 deadline=30, poolConnections=10, poolMaxSize=32, workers=16, chunkSize=64 * 1024):
+        self.maxBytes = maxBytes
+        self.timeout = (connectTimeout, readTimeout)
+        self.deadline = deadline
+        self.chunkSize = chunkSize
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxSize, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def fetch(self, url, headers=None):
+        """
+            Downloads an image. Returns a FetchedImage, a 304 answer to a
+            conditional GET comes back with an empty body
+        """
+        start = time.monotonic()
+        expired = threading.Event()
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                # iter_content blocks until a whole chunk arrives, a server dripping
+                # bytes just under the read timeout would never reach a check
+                # between chunks. The timer cuts the connection at the deadline
+                timer = threading.Timer(max(self.deadline - (time.monotonic() - start), 0), self.expire, (r, expired))
+                timer.daemon = True
+                timer.start()
+                try:
+                    image = self.read(r, expired)
+                finally:
+                    timer.cancel()
+        except requests.exceptions.Timeout:
+            raise FetchError("The image server timed out")
+        except requests.exceptions.RequestException as e:
+            if expired.is_set():
+                raise FetchError(f"The image download took more than {self.deadline} seconds")
+            raise FetchError(f"The image could not be downloaded: {e.__class__.__name__}")
+
+        # A body cut at the deadline may look complete when it has no Content-Length
+        if expired.is_set():
+            raise FetchError(f"The image download took more than {self.deadline} seconds")
+        return image
+
+    def expire(self, r, expired):
+        """
+            Ends the download of r. Closing a socket doesn't wake the thread blocked
+            reading it, shutting it down does. The socket is reached through the
+            connection urllib3 exposes on the raw response and its http.client sock
+        """
+        expired.set()
+        sock = getattr(getattr(r.raw, "connection", None), "sock", None)
+        if sock is None:
+            logger.warning("The socket of %s can't be shut down at the deadline, the download "
+                           "stops at the next chunk or read timeout instead", r.url)
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def read(self, r, expired):
+        """
+            Reads the body of an answer, up to maxBytes. Stops with a FetchError once
+            expired is set
+        """
+        if r.status_code == 304:
+            return FetchedImage(304, b"", r.headers)
+        if r.status_code != 200:
+            raise FetchError(f"The image server answered with status {r.status_code}")
+
+        length = r.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > self.maxBytes:
+            raise FetchError(f"The image is bigger than {self.maxBytes} bytes")
+
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(self.chunkSize):
+            if expired.is_set():
+                raise FetchError(f"The image download took more than {self.deadline} seconds")
+            size += len(chunk)
+            if size > self.maxBytes:
+                raise FetchError(f"The image is bigger than {self.maxBytes} bytes")
+            chunks.append(chunk)
+
+        return FetchedImage(200, b"".join(chunks), r.headers)
+
+    def submit(self, url, headers=None):
+        """
+            Async mode, returns a Future of fetch(url, headers)
+        """
+        return self.executor.submit(self.fetch, url, headers)
+
+    def fetchMany(self, urls):
+        """
+            Starts every download at once, returns one Future per URL in order
+        """
+        return [self.submit(url) for url in urls]
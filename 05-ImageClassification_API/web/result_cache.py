@@ -0,0 +1,167 @@
+"""
+    Content-addressed cache of classification results
+"""
+
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import pymongo
+
+
+def imageDigest(image_data):
+    """
+        Cache key of an image: SHA-256 of its bytes
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class ResultCache:
+    """
+        Two tier cache of top k predictions keyed by image digest. The first
+        tier is an in-memory LRU private to the worker, the second one is a
+        MongoDB collection shared by every worker. Entries expire after
+        ttlSeconds in both tiers; each tier also evicts its oldest entries
+        once it holds more than its max entries.
+
+        Besides the digest, the cache remembers the ETag/Last-Modified of every
+        URL it saw, so a repeated URL can be revalidated with a conditional GET
+        instead of being downloaded again.
+    """
+    def __init__(self, results, urls, maxEntries=1024, maxDbEntries=100000, ttlSeconds=86400):
+        self.results = results
+        self.urls = urls
+        self.maxEntries = maxEntries
+        self.maxDbEntries = maxDbEntries
+        self.ttl = ttlSeconds
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memoryHits = 0
+        self.dbHits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.puts = 0
+
+    def createIndexes(self):
+        """
+            TTL indexes let MongoDB drop expired entries on its own
+        """
+        self.results.create_index("CreatedAt", expireAfterSeconds=self.ttl)
+        self.urls.create_index("CreatedAt", expireAfterSeconds=self.ttl)
+
+    def get(self, digest):
+        """
+            Returns the cached predictions of an image digest or None
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.memory.get(digest)
+            if entry is not None and entry[0] > now:
+                self.memory.move_to_end(digest)
+                self.memoryHits += 1
+                return entry[1]
+
+        doc = self.results.find_one({"_id": digest})
+        if doc is None or doc["CreatedAt"] + datetime.timedelta(seconds=self.ttl) < datetime.datetime.utcnow():
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # Predictions are stored as [label, score] pairs, labels aren't safe
+        # to use as MongoDB field names
+        result = dict(doc["Result"])
+        with self.lock:
+            self.dbHits += 1
+            self.remember(digest, result, now)
+        return result
+
+    def put(self, digest, result):
+        """
+            Stores the predictions of an image digest in both tiers
+        """
+        with self.lock:
+            self.remember(digest, result, time.monotonic())
+            self.puts += 1
+            trim = self.puts % 100 == 0
+
+        self.results.replace_one({"_id": digest}, {
+            "_id": digest,
+            "Result": list(result.items()),
+            "CreatedAt": datetime.datetime.utcnow()
+        }, upsert=True)
+
+        if trim:
+            self.trim()
+
+    def remember(self, digest, result, now):
+        """
+            Adds an entry to the memory tier, the caller holds the lock
+        """
+        self.memory[digest] = (now + self.ttl, result)
+        self.memory.move_to_end(digest)
+        while len(self.memory) > self.maxEntries:
+            self.memory.popitem(last=False)
+
+    def trim(self):
+        """
+            Size based eviction of the MongoDB tier, the oldest entries go first
+        """
+        excess = self.results.estimated_document_count() - self.maxDbEntries
+        if excess <= 0:
+            return
+        oldest = self.results.find({}, {"_id": 1}).sort("CreatedAt", pymongo.ASCENDING).limit(excess)
+        self.results.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
+
+    def validators(self, url):
+        """
+            Returns the conditional GET headers and the digest last seen for
+            an URL, or ({}, None) if the URL is unknown
+        """
+        doc = self.urls.find_one({"_id": url})
+        if doc is None:
+            return {}, None
+
+        headers = {}
+        if doc.get("ETag"):
+            headers["If-None-Match"] = doc["ETag"]
+        if doc.get("LastModified"):
+            headers["If-Modified-Since"] = doc["LastModified"]
+        if not headers:
+            return {}, None
+        return headers, doc["Digest"]
+
+    def putUrl(self, url, etag, lastModified, digest):
+        """
+            Remembers the validators of an URL together with its image digest
+        """
+        if not etag and not lastModified:
+            return
+        self.urls.replace_one({"_id": url}, {
+            "_id": url,
+            "ETag": etag,
+            "LastModified": lastModified,
+            "Digest": digest,
+            "CreatedAt": datetime.datetime.utcnow()
+        }, upsert=True)
+
+    def markRevalidated(self):
+        with self.lock:
+            self.revalidated += 1
+
+    def stats(self):
+        """
+            Hit/miss counters of the cache
+        """
+        with self.lock:
+            lookups = self.memoryHits + self.dbHits + self.misses
+            return {
+                "memoryHits": self.memoryHits,
+                "dbHits": self.dbHits,
+                "misses": self.misses,
+                "hitRatio": (self.memoryHits + self.dbHits) / lookups if lookups else 0,
+                "revalidated": self.revalidated,
+                "memoryEntries": len(self.memory)
+            }
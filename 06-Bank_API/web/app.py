@@ -2,18 +2,44 @@
     API for manage Bank transactions
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g, Response, stream_with_context
 from flask_restful import Api, Resource
-from pymongo import MongoClient
-import bcrypt
+import datetime
+import functools
+import json
+import os
+from pymongo import MongoClient, monitoring
+from pymongo.errors import DuplicateKeyError
+from auth import checkPassword, hashPassword, SessionTokens, bearerToken, cryptoExecutor
+from bank_ledger import BankLedger, FeeCounter, DuplicateMovement, LeaseExpired
+from idempotency import IdempotencyKeys
 
 app = Flask(__name__)
 api = Api(app)
 
+class CommandCounter(monitoring.CommandListener):
+    """
+        Counts the commands sent to MongoDB, tests read mongoOps.count, or the mongoOps of
+        /metrics, before and after a call to know how many round trips an endpoint makes
+    """
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongoOps = CommandCounter()
+
 # When the mongoDB client is created //db must be the same name defined in the file 
 # Default mongoDB port is 27017
 # docker-compose.yml for the mongoDB container
-client = MongoClient("mongodb://db:27017")
+client = MongoClient("mongodb://db:27017", event_listeners=[mongoOps])
 
 #Step 1: create a DB
 db = client.BankAPI
@@ -21,6 +47,42 @@ db = client.BankAPI
 # Step 2: create collections
 users = db["Users"]
 
+# Fields of the user document the API reads
+USER_FIELDS = {"_id": 0, "Username": 1, "Password": 1, "Money": 1, "Debt": 1}
+
+# Money moves through the ledger, movements over several accounts are journaled.
+# The 1 USD transaction fees are collected in the striped Fees counter
+feeCounter = FeeCounter(db["Fees"])
+bankLedger = BankLedger(users, db["Journal"], db["Transactions"], feeCounter)
+
+# /statement pages have STATEMENT_PAGE_SIZE transactions unless the request
+# asks for another limit, up to MAX_STATEMENT_PAGE_SIZE
+STATEMENT_PAGE_SIZE = int(os.environ.get("STATEMENT_PAGE_SIZE", 100))
+MAX_STATEMENT_PAGE_SIZE = int(os.environ.get("MAX_STATEMENT_PAGE_SIZE", 1000))
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Responses of the requests sent with an Idempotency-Key, for their retries
+idempotencyKeys = IdempotencyKeys(db["IdempotencyKeys"], bankLedger)
+
+# Signed session tokens, revoked ones are tracked in RevokedTokens
+sessions = SessionTokens(db["RevokedTokens"])
+
+# Start the bcrypt worker processes before the web server starts its threads
+cryptoExecutor.warmUp()
+
+def createIndexes():
+    """
+        Creates the indexes the queries of the API need. create_index does nothing when
+        the index already exists, so every worker runs it at start
+    """
+    # Every query looks users up by Username, unique so /register can't create duplicates
+    users.create_index("Username", unique=True)
+    sessions.createIndexes()
+    bankLedger.createIndexes()
+    idempotencyKeys.createIndexes()
+
+createIndexes()
+
 """ 
 ****************************AUXILIAR FUNTCIONS***********************************
 """
@@ -31,67 +93,137 @@ def genJson(errCode, errMsg):
     }
     return retJson     
 
+def loadUser(username):
+    """
+        Auxiliar function that returns the document of a user, or None. The document is read
+        once per request, with only the fields listed in USER_FIELDS, and every helper
+        reuses it. Helpers that write the user document call invalidateUser
+    """
+    loaded = g.setdefault("users", {})
+    if username not in loaded:
+        loaded[username] = users.find_one({"Username": username}, USER_FIELDS)
+    return loaded[username]
+
+def invalidateUser(username):
+    """
+        Auxiliar function that drops the memoized document of a user after a write
+    """
+    g.get("users", {}).pop(username, None)
+
 def userExist(username):
     """
         Auxiliar function to check if a username already exists in the DB.
         Return True if exists, otherwise returns False
     """
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    return users.find(SELECTION_CRITERIA).count() > 0
+    return loadUser(username) is not None
 
-def verifyCredentials(username,password):
+def verifyPassword(username,password):
     """
-        Auxiliar function to verify the credentials of username and password. 
-        Return True or False
+        Auxiliar function to verify the credentials of username and password, ignoring
+        any bearer token. Return the error JSON and False, or None and True
     """
     if not userExist(username):
         errJson = genJson(301, f"Invalid username. User {username} already exists")
         return errJson, False
 
-    hashed_pw = users.find({"Username": username})[0]["Password"]
-    if bcrypt.hashpw(password.encode('utf8'),hashed_pw) != hashed_pw:
+    hashed_pw = loadUser(username)["Password"]
+    if password is None or not checkPassword(username, password, hashed_pw):
         errJson = genJson(302, f"Invalid password for User {username}")
         return errJson, False
     
     return None, True
 
-def getMoney(username):
+def verifyCredentials(username,password):
     """
-        Auxiliar function returns amount of Money a username have
+        Auxiliar function to verify the credentials of username and password. 
+        Return True or False. A bearer token in the request replaces the password
     """
-    return users.find({"Username": username})[0]["Money"]
+    token = bearerToken()
+    if token is not None:
+        if sessions.verify(token) != username:
+            errJson = genJson(302, f"Invalid or expired session token for User {username}")
+            return errJson, False
+        return None, True
+
+    return verifyPassword(username, password)
 
-def getDebt(username):
+def idempotent(post):
     """
-        Auxiliar function returns amount of Debt a username have
+        Auxiliar decorator for the POST functions that move money. A request with an
+        Idempotency-Key header runs only once: its retries, from the same user and with
+        the same body, get the first response back without touching any balance. The
+        claim of the key is kept in g.idempotencyClaim, for the ledger
     """
-    return users.find({"Username": username})[0]["Debt"]
+    @functools.wraps(post)
+    def wrapper(self):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            try:
+                return post(self)
+            except LeaseExpired:
+                # This run was too slow, the ledger recovers its movement
+                return jsonify({
+                    "status": 309,
+                    "msg": "The request is still in progress, check your balance later"
+                })
+
+        # Only the owner of a key can read its responses
+        postedData = request.get_json()
+        username = postedData["username"]
+        retJson, validCredentials = verifyCredentials(username, postedData.get("password"))
+        if not validCredentials:
+            return jsonify(retJson)
+
+        retJson, claim = idempotencyKeys.begin(username, key, postedData)
+        if retJson is not None:
+            return jsonify(retJson)
+
+        g.idempotencyClaim = claim
+        try:
+            response = post(self)
+        except (DuplicateMovement, LeaseExpired):
+            # An earlier run of this request, whose lease expired, journaled the movement,
+            # or this run was too slow and the ledger recovers its movement
+            return jsonify(idempotencyKeys.inProgress())
+        except Exception:
+            idempotencyKeys.abandon(username, key, claim)
+            raise
+
+        idempotencyKeys.finish(username, key, postedData, response.get_json())
+        return response
 
-def setMoney(username, balance):
+    return wrapper
+
+def encodeCursor(transaction):
     """
-        Auxiliar function update the amount of Money a username have
+        Auxiliar function that returns the cursor of a page ending at a transaction: its
+        timestamp, in milliseconds, and its id
     """
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Money": balance
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    millis = (transaction["Timestamp"] - EPOCH) // datetime.timedelta(milliseconds=1)
+    return f"{millis}-{transaction['_id']}"
 
-def setDebt(username, balance):
+def decodeCursor(cursor):
     """
-        Auxiliar function update amount of Debt a username have
+        Auxiliar function that returns the (timestamp, id) of a cursor, or None for no
+        cursor. Raise ValueError if the cursor is malformed, OverflowError if its
+        timestamp is out of range
     """
-    SELECTION_CRITERIA = {
-        "Username": username
-    }
-    UPDATED_DATA = {
-        "Debt": balance
-    }
-    users.update(SELECTION_CRITERIA,{"$set":UPDATED_DATA})
+    if cursor is None:
+        return None
+    millis, _, transactionId = str(cursor).partition("-")
+    return EPOCH + datetime.timedelta(milliseconds=int(millis)), transactionId
+
+def transactionJson(transaction):
+    """
+        Auxiliar function that returns a transaction ready for JSON
+    """
+    return dict(transaction, Timestamp=transaction["Timestamp"].isoformat() + "Z")
+
+def getMoney(username):
+    """
+        Auxiliar function returns amount of Money a username have
+    """
+    return loadUser(username)["Money"]
 
 
 
@@ -118,31 +250,75 @@ class Register(Resource):
         username = postedData["username"]
         password = postedData["password"]
 
-        # Step 3: Check if user already exists
-        if userExist(username):
+        # Step 3: Hash the password with bcrypt, on the crypto pool
+        hashed_pw = hashPassword(password)
+
+        # Step 4: Store in the DB the info of the new user bankAPI        
+        # The unique index on Username rejects a user that already exists
+        try:
+            users.insert_one({
+                "Username": username,
+                "Password": hashed_pw,
+                "Money": 0,
+                "Debt": 0
+
+            })
+        except DuplicateKeyError:
             retJson = genJson(301, f"Invalid username. User {username} already exists")
             return jsonify(retJson)
 
-        # Step 4: Hash the password with bcrypt
-        hashed_pw = bcrypt.hashpw(password.encode('utf8'),bcrypt.gensalt())
+        # Step 5: Return message to the user
+        retJson = genJson(200, "You successfully signed up for the API")
+        return jsonify(retJson)
 
-        # Step 4: Store in the DB the info of the new user bankAPI        
-        users.insert({
-            "Username": username,
-            "Password": hashed_pw,
-            "Money": 0,
-            "Debt": 0
+class Login(Resource):
+    """
+        Class to open a session
+    """
+    def post(self):
+        """
+            POST Function that exchanges the username and password for a bearer token.
+            The other resources accept the header "Authorization: Bearer <token>"
+            instead of the password until the token expires
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
 
-        })
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData["password"]
 
-        # Step 5: Return message to the user
-        retJson = genJson(200, "You successfully signed up for the API")
+        # Step 3: Verify credentials. A token can't open a new session, the
+        # password is always required
+        retJson, validCredentials = verifyPassword(username,password)
+        if not validCredentials:
+            return jsonify(retJson)
+
+        # Step 4: Issue the token
+        retJson = genJson(200, "Session opened")
+        retJson["token"] = sessions.issue(username)
+        retJson["expiresIn"] = sessions.ttl
         return jsonify(retJson)
 
+class Logout(Resource):
+    """
+        Class to close a session
+    """
+    def post(self):
+        """
+            POST Function that revokes the bearer token of the request
+        """
+        token = bearerToken()
+        if token is None or not sessions.revoke(token):
+            return jsonify(genJson(302, "Invalid session token"))
+
+        return jsonify(genJson(200, "Session closed"))
+
 class Add(Resource):
     """
         Class to add money to and account
     """
+    @idempotent
     def post(self):
         """
             POST Function that handles the adding money to an account
@@ -152,7 +328,7 @@ class Add(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         amount = postedData["amount"]
 
         # Step 3: Verify credentials
@@ -165,13 +341,10 @@ class Add(Resource):
             retJson = genJson(304,"The amount must be greater than 0")
             return jsonify(retJson)
 
-        # Step 5: Get the money of the username, charge 1 USD for every transaction and
-        # add that money to the BANK account and the user Account
-        balance = getMoney(username) + amount - 1
-        setMoney(username, balance)
-
-        bankMoney = getMoney("BANK")
-        setMoney("BANK", bankMoney+1)
+        # Step 5: Add the money to the user account, charge 1 USD for every transaction
+        # and add it to the BANK account
+        balance = bankLedger.deposit(username, amount, 1, g.get("idempotencyClaim"))["Money"]
+        invalidateUser(username)
 
         # Step 6: return 200 OK
         retJson = genJson(200,f"Amount added succesfully, the new balance is ${balance}")        
@@ -181,6 +354,7 @@ class Transfer(Resource):
     """
         Transfer money
     """
+    @idempotent
     def post(self):
         """
             POST Function that transfer money from an user to another user
@@ -190,7 +364,7 @@ class Transfer(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         amount = postedData["amount"]
         to = postedData["to"]
 
@@ -209,20 +383,18 @@ class Transfer(Resource):
             retJson = genJson(301, f"User {to} does not exists")
             return jsonify(retJson)
 
-        # Step 6: Verify if the user have enough money to send 
-        balanceFrom = getMoney(username) - amount - 1
+        # Step 6: Make the transfer, the money is only taken if the user have enough
+        # to send plus the 1 USD charge
+        account = bankLedger.transfer(username, to, amount, 1, g.get("idempotencyClaim"))
+        invalidateUser(username)
+        invalidateUser(to)
 
-        if balanceFrom < 0:
+        if account is None:
             retJson = genJson(306,"Transfer amount is higher than amount in the account. Please add or take a loan")
             return jsonify(retJson)
 
-        # Step 7: Make the transfer and update the amounts
-        balanceTo   = getMoney(to) + amount       
-        balanceBank = getMoney("BANK") + 1
-
-        setMoney(username, balanceFrom)
-        setMoney(to, balanceTo)
-        setMoney("BANK", balanceBank)
+        # Step 7: Get the new balance
+        balanceFrom = account["Money"]
 
         # Step 8: return 200 OK
         retJson = genJson(200,f"Amount transfer succesfully, you're new balance is ${balanceFrom}")        
@@ -241,20 +413,19 @@ class BalanceCheck(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
 
         # Step 3: Verify credentials
         retJson, validCredentials = verifyCredentials(username,password)
         if not validCredentials:
             return jsonify(retJson)
 
-        # Step 4: Get the data of the user using Projections
-        retJson = users.find({
-            "Username": username
-        }, {
-            "Password": 0,
-            "_id":0
-        })[0]      
+        # Step 4: Get the data of the user, without the password. The BANK also owns
+        # every fee collected
+        retJson = dict(loadUser(username))
+        retJson.pop("Password")
+        if username == "BANK":
+            retJson["Money"] += feeCounter.total()
 
         # Step 8: return 200 OK
         return jsonify(retJson)
@@ -263,6 +434,7 @@ class TakeLoan(Resource):
     """
         Class to take a loan from the Bank
     """
+    @idempotent
     def post(self):
         """
             POST Function that handles taking a loan
@@ -272,7 +444,7 @@ class TakeLoan(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         loanAmount = postedData["amount"]
 
         # Step 3: Verify credentials
@@ -281,20 +453,18 @@ class TakeLoan(Resource):
             return jsonify(retJson)
 
         # Step 4: Update the cash and the debt for the user. This is out of charges
-        cash = getMoney(username)
-        debt = getDebt(username)
-
-        setMoney(username, cash+loanAmount)
-        setDebt(username, debt+loanAmount)
+        account = bankLedger.takeLoan(username, loanAmount, g.get("idempotencyClaim"))
+        invalidateUser(username)
 
         # Step 6: return 200 OK
-        retJson = genJson(200,f"Load added succesfully, the new balance is ${cash+loanAmount}")        
+        retJson = genJson(200,f"Load added succesfully, the new balance is ${account['Money']}")        
         return jsonify(retJson)
 
 class PayLoan(Resource):
     """
         Class to pay a loan from the Bank
     """
+    @idempotent
     def post(self):
         """
             POST Function that handles paying a loan
@@ -304,7 +474,7 @@ class PayLoan(Resource):
 
         # Step 2: Get the data
         username = postedData["username"]
-        password = postedData["password"]
+        password = postedData.get("password")
         payAmount = postedData["amount"]
 
         # Step 3: Verify credentials
@@ -312,29 +482,90 @@ class PayLoan(Resource):
         if not validCredentials:
             return jsonify(retJson)
 
-        # Step 4: Verify if the user have enough money to pay the desired amount
-        cash = getMoney(username) 
+        # Step 4: Update the cash and the debt for the user, only if the user have
+        # enough money and the amount isn't greater than the debt. This is out of charges
+        account = bankLedger.payLoan(username, payAmount, g.get("idempotencyClaim"))
+        invalidateUser(username)
 
-        if cash < payAmount:
-            retJson = genJson(303,"Not enough money in your account, please reconsider the amount to pay")
-            return jsonify(retJson)
-
-        # Step 4: Verify if the amount money to pay isn't greater than the debt
-        debt = getDebt(username)
+        # Step 5: When the payment wasn't made, tell the user why
+        if account is None:
+            if getMoney(username) < payAmount:
+                retJson = genJson(303,"Not enough money in your account, please reconsider the amount to pay")
+                return jsonify(retJson)
 
-        if debt < payAmount:
             retJson = genJson(305,f"Please check, you're trying to pay more")
-            return jsonify(retJson)    
-        
-        # Step 6: Update the cash and the debt for the user. This is out of charges
-        setMoney(username, cash - payAmount)
-        setDebt(username, debt - payAmount)
+            return jsonify(retJson)
 
-        # Step 7: return 200 OK
+        # Step 6: return 200 OK
         retJson = genJson(200,"Paid loan succesfully")        
         return jsonify(retJson)
 
 
+class Statement(Resource):
+    """
+        Class to get the transactions of an account
+    """
+    def post(self):
+        """
+            POST Function that returns the transactions of a user, oldest first, a page
+            at a time: the "next" of a page is the "after" of the following one. With
+            "format": "ndjson" every transaction after "after" is streamed instead, one
+            JSON per line
+        """
+        # Step 1: Get posted data by the user
+        postedData = request.get_json()
+
+        # Step 2: Get the data
+        username = postedData["username"]
+        password = postedData.get("password")
+        after = postedData.get("after")
+        limit = postedData.get("limit", STATEMENT_PAGE_SIZE)
+        export = postedData.get("format") == "ndjson"
+
+        # Step 3: Verify credentials
+        retJson, validCredentials = verifyCredentials(username,password)
+        if not validCredentials:
+            return jsonify(retJson)
+
+        # Step 4: Verify the page requested
+        if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= MAX_STATEMENT_PAGE_SIZE:
+            retJson = genJson(307, f"The limit must be between 1 and {MAX_STATEMENT_PAGE_SIZE}")
+            return jsonify(retJson)
+        try:
+            after = decodeCursor(after)
+        except (ValueError, OverflowError):
+            retJson = genJson(307, "Invalid cursor")
+            return jsonify(retJson)
+
+        # Step 5: Stream the export, the cursor reads the transactions in batches
+        # while they're sent
+        if export:
+            transactions = bankLedger.history(username, after).batch_size(STATEMENT_PAGE_SIZE)
+            lines = (json.dumps(transactionJson(transaction)) + "\n" for transaction in transactions)
+            return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+        # Step 6: Return the page and the cursor of the next one
+        transactions = list(bankLedger.history(username, after, limit))
+        retJson = genJson(200, f"{len(transactions)} transactions")
+        retJson["transactions"] = [transactionJson(transaction) for transaction in transactions]
+        retJson["next"] = encodeCursor(transactions[-1]) if len(transactions) == limit else None
+        return jsonify(retJson)
+
+class Metrics(Resource):
+    """
+        Metrics of this worker
+    """
+    def get(self):
+        """
+            GET Function that returns the number of MongoDB commands sent so far and the
+            crypto pool metrics
+        """
+        return jsonify({
+            "crypto": cryptoExecutor.stats(),
+            "mongoOps": mongoOps.count
+        })
+
+
 """ 
 ********************end API Resources Class definition****************************
 """
@@ -344,11 +575,15 @@ class PayLoan(Resource):
 ********************Adding the resources to the API****************************
 """
 api.add_resource(Register,'/register')
+api.add_resource(Login,'/login')
+api.add_resource(Logout,'/logout')
 api.add_resource(Add,'/add')
 api.add_resource(Transfer,'/transfer')
 api.add_resource(BalanceCheck,'/balanceCheck')
 api.add_resource(TakeLoan,'/takeLoan')
 api.add_resource(PayLoan,'/payLoan')
+api.add_resource(Statement,'/statement')
+api.add_resource(Metrics,'/metrics')
 """ 
 ****************end Adding the resources to the API****************************
 """
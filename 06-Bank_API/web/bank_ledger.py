@@ -0,0 +1,438 @@
+"""
+    Money movements of the Bank API, applied with conditional $inc updates
+    and journaled so a movement that touches several accounts is never left
+    half applied. Every movement is also recorded in the append-only
+    transactions collection, the history of each account
+"""
+
+import datetime
+import logging
+import os
+import random
+import threading
+import time
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Finished journal entries are kept JOURNAL_TTL seconds, movements still
+# pending LEDGER_RECOVER_AFTER seconds after they started are recovered
+JOURNAL_TTL = int(os.environ.get("JOURNAL_TTL", 7 * 24 * 3600))
+LEDGER_RECOVER_AFTER = int(os.environ.get("LEDGER_RECOVER_AFTER", 60))
+
+# The transaction fees are spread over FEE_STRIPES counter documents
+FEE_STRIPES = int(os.environ.get("FEE_STRIPES", 16))
+
+ACCOUNT_FIELDS = {"_id": 0, "Money": 1, "Debt": 1}
+
+# Order of the transactions of an account, the _id breaks timestamp ties
+HISTORY_ORDER = [("Timestamp", ASCENDING), ("_id", ASCENDING)]
+
+
+class LedgerError(Exception):
+    """
+        Raised when an account credited by a movement doesn't exist
+    """
+
+
+class DuplicateMovement(LedgerError):
+    """
+        Raised when the journal already has a movement for an idempotency claim
+    """
+
+
+class LeaseExpired(LedgerError):
+    """
+        Raised when a worker drove a movement past its lease: recover() may have
+        claimed it, the worker stops and leaves the movement to the new driver
+    """
+
+
+class FeeCounter:
+    """
+        The fees collected by the bank, striped over several counter documents
+        of the fees collection. Each fee goes to a random stripe, so concurrent
+        movements rarely update the same document, and the total is the sum of
+        every stripe
+    """
+    def __init__(self, fees, stripes=FEE_STRIPES):
+        self.fees = fees
+        self.stripes = stripes
+
+    def createStripes(self):
+        """
+            The ledger only updates existing stripes, they're created at start
+        """
+        for stripe in range(self.stripes):
+            self.fees.update_one({"_id": stripe}, {"$setOnInsert": {"Money": 0}}, upsert=True)
+
+    def pick(self):
+        return random.randrange(self.stripes)
+
+    def total(self):
+        """
+            Sum of the fees of every stripe
+        """
+        result = list(self.fees.aggregate([{"$group": {"_id": None, "Money": {"$sum": "$Money"}}}]))
+        return result[0]["Money"] if result else 0
+
+
+class BankLedger:
+    """
+        Moves money between the accounts of the users collection. The MongoDB
+        of the API is a standalone server, without multi-document
+        transactions, so a movement over several accounts is first written to
+        the journal and then applied one account at a time. Each account keeps
+        in Pending the ids of the movements applied to it and not yet
+        finished, which makes every step idempotent: recover() can safely
+        finish, or cancel, whatever a crashed worker left behind. Fees go to
+        the stripes of feeCounter, not to one bank account every movement
+        would have to update, and appear in the history of the bank user.
+
+        A movement has one driver at a time, the worker that journaled it or
+        the one that recovered it, stored in Driver. recover() claims a
+        movement with a conditional update once recoverAfter seconds passed
+        since its last claim, a driver stops applying entries after half
+        that, and every change of State is conditional on the driver and the
+        previous State. So no two workers apply the entries of one movement,
+        which the Pending guards alone don't prevent once commit() removes
+        them
+    """
+    def __init__(self, users, journal, transactions, feeCounter, bank="BANK",
+                 journalTtl=JOURNAL_TTL, recoverAfter=LEDGER_RECOVER_AFTER):
+        self.users = users
+        self.journal = journal
+        self.transactions = transactions
+        self.feeCounter = feeCounter
+        self.bank = bank
+        self.journalTtl = journalTtl
+        self.recoverAfter = recoverAfter
+        self.recovering = threading.Lock()
+        self.lastRecover = time.monotonic()
+
+    def createIndexes(self):
+        """
+            recover() looks movements up by state and time of their last claim, or age
+            for those journaled before claims, finished ones expire. Statements read the
+            transactions of one user in time order. An idempotency claim journals at most
+            one movement
+        """
+        self.journal.create_index([("State", 1), ("ClaimedAt", 1)])
+        self.journal.create_index([("State", 1), ("CreatedAt", 1)])
+        self.journal.create_index("IdempotencyKey", unique=True,
+                                  partialFilterExpression={"IdempotencyKey": {"$exists": True}})
+        self.transactions.create_index([("Username", ASCENDING)] + HISTORY_ORDER)
+        self.journal.create_index("DoneAt", expireAfterSeconds=self.journalTtl)
+        self.feeCounter.createStripes()
+
+    def deposit(self, username, amount, fee, key=None):
+        """
+            Adds amount minus the fee to an account, the fee goes to the bank.
+            Return the account after the deposit
+        """
+        return self.move("add", [
+            ({"Username": username}, {"Money": amount - fee}, None),
+            ({"Stripe": self.feeCounter.pick()}, {"Money": fee}, None)
+        ], key)
+
+    def transfer(self, sender, receiver, amount, fee, key=None):
+        """
+            Moves amount from sender to receiver, the sender also pays the fee to
+            the bank. Return the account of the sender after the transfer, or None,
+            without moving anything, if the sender has less than amount plus fee
+        """
+        return self.move("transfer", [
+            ({"Username": sender}, {"Money": -(amount + fee)}, {"Money": amount + fee}),
+            ({"Username": receiver}, {"Money": amount}, None),
+            ({"Stripe": self.feeCounter.pick()}, {"Money": fee}, None)
+        ], key)
+
+    def takeLoan(self, username, amount, key=None):
+        """
+            Adds amount to both the money and the debt of an account. It touches one
+            document but goes through the journal so the loan and its history entry
+            are written together. Return the account after the loan
+        """
+        return self.move("loan", [
+            ({"Username": username}, {"Money": amount, "Debt": amount}, None)
+        ], key)
+
+    def payLoan(self, username, amount, key=None):
+        """
+            Takes amount away from both the money and the debt of an account. Return
+            the account after the payment, or None, without paying anything, if the
+            account has less money or less debt than amount
+        """
+        return self.move("payLoan", [
+            ({"Username": username}, {"Money": -amount, "Debt": -amount}, {"Money": amount, "Debt": amount})
+        ], key)
+
+    def move(self, kind, entries, key=None):
+        """
+            Journals and applies a movement of type kind. entries is a list of (account,
+            increments, minimums), where account is {"Username": username} or
+            {"Stripe": stripe}. Only the first account may require minimums and it's the
+            one returned. Return None if the minimums aren't met, the movement is cancelled.
+            key is the idempotency claim of the request, raise DuplicateMovement if a
+            movement of the claim is already journaled
+        """
+        self.maybeRecover()
+
+        # An account that appears twice, e.g. a transfer to oneself, gets one entry
+        merged = {}
+        for account, increments, minimums in entries:
+            entry = merged.setdefault(tuple(account.items()), dict(account, Inc={}))
+            for field, value in increments.items():
+                entry["Inc"][field] = entry["Inc"].get(field, 0) + value
+            if minimums:
+                entry["Minimum"] = minimums
+
+        driver = self.lease()
+        now = datetime.datetime.utcnow()
+        movement = {
+            "_id": ObjectId(),
+            "Type": kind,
+            "State": "pending",
+            "Entries": list(merged.values()),
+            "CreatedAt": now,
+            "Driver": driver["Id"],
+            "ClaimedAt": now
+        }
+        if key is not None:
+            movement["IdempotencyKey"] = key
+        try:
+            self.journal.insert_one(movement)
+        except DuplicateKeyError:
+            raise DuplicateMovement(f"A movement of claim {key} is already journaled")
+
+        account = self.apply(movement, driver)
+        if account is None:
+            self.finish(movement, driver, "cancelled")
+            return None
+
+        self.commit(movement, driver)
+        return account
+
+    def lease(self):
+        """
+            A new driver of a movement: its id and the time.monotonic() its lease ends,
+            half of recoverAfter from now
+        """
+        return {"Id": ObjectId(), "Until": time.monotonic() + self.recoverAfter / 2}
+
+    def checkLease(self, movement, driver):
+        if time.monotonic() > driver["Until"]:
+            raise LeaseExpired(f"The lease of movement {movement['_id']} expired")
+
+    def transition(self, movement, driver, update):
+        """
+            Changes the State of a movement with update, if driver still drives it and
+            its State is the one in movement. Raise LeaseExpired otherwise
+        """
+        result = self.journal.update_one(
+            {"_id": movement["_id"], "State": movement["State"], "Driver": driver["Id"]}, update)
+        if result.matched_count == 0:
+            raise LeaseExpired(f"Movement {movement['_id']} is driven by another worker")
+        movement["State"] = update["$set"]["State"]
+
+    def account(self, entry):
+        """
+            Return the collection and the selection criteria of the account of an entry
+        """
+        if "Stripe" in entry:
+            return self.feeCounter.fees, {"_id": entry["Stripe"]}
+        return self.users, {"Username": entry["Username"]}
+
+    def applyEntry(self, movementId, entry):
+        """
+            Applies one entry unless it already was. Return the account, or None if it
+            doesn't exist or doesn't meet the minimums of the entry
+        """
+        collection, selection = self.account(entry)
+        criteria = dict(selection, Pending={"$ne": movementId})
+        for field, minimum in entry.get("Minimum", {}).items():
+            criteria[field] = {"$gte": minimum}
+
+        account = collection.find_one_and_update(
+            criteria,
+            {"$inc": entry["Inc"], "$addToSet": {"Pending": movementId}},
+            projection=ACCOUNT_FIELDS,
+            return_document=ReturnDocument.AFTER
+        )
+        if account is None:
+            # An earlier attempt of this movement may have applied it already
+            account = collection.find_one(dict(selection, Pending=movementId), ACCOUNT_FIELDS)
+        return account
+
+    def apply(self, movement, driver):
+        entries = movement["Entries"]
+        self.checkLease(movement, driver)
+        account = self.applyEntry(movement["_id"], entries[0])
+        if account is None:
+            return None
+
+        for entry in entries[1:]:
+            self.checkLease(movement, driver)
+            if self.applyEntry(movement["_id"], entry) is None:
+                raise LedgerError(f"Account {self.account(entry)[1]} does not exist")
+        return account
+
+    def record(self, movement):
+        """
+            Appends one transaction per account of the movement. Their ids derive from
+            the movement id, so a movement recorded twice keeps a single copy
+        """
+        entries = movement["Entries"]
+        initiator = entries[0]["Username"]
+        users = [entry["Username"] for entry in entries if "Username" in entry]
+        transactions = []
+        for n, entry in enumerate(entries):
+            username = entry.get("Username", self.bank)
+            if n > 0:
+                counterparty = initiator
+            else:
+                counterparty = users[1] if len(users) > 1 else None
+            transactions.append({
+                "_id": f"{movement['_id']}:{n}",
+                "Username": username,
+                "Timestamp": movement["CreatedAt"],
+                "Type": "fee" if "Stripe" in entry else movement["Type"],
+                "Money": entry["Inc"].get("Money", 0),
+                "Debt": entry["Inc"].get("Debt", 0),
+                "Counterparty": counterparty
+            })
+        try:
+            self.transactions.insert_many(transactions, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    def history(self, username, after=None, limit=None):
+        """
+            Cursor over the transactions of a user in time order, starting after the
+            (Timestamp, _id) of after. The range query walks the index, no matter how
+            far into the history the page is
+        """
+        criteria = {"Username": username}
+        if after is not None:
+            timestamp, transactionId = after
+            criteria["$or"] = [
+                {"Timestamp": {"$gt": timestamp}},
+                {"Timestamp": timestamp, "_id": {"$gt": transactionId}}
+            ]
+
+        cursor = self.transactions.find(criteria, {"Username": 0}).sort(HISTORY_ORDER)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def commit(self, movement, driver):
+        """
+            Second phase: once every entry is applied the movement is marked applied,
+            recorded in the transactions and its id is removed from the accounts. No
+            entry is applied once it's marked applied, so removing the ids is safe
+        """
+        if movement["State"] == "pending":
+            self.checkLease(movement, driver)
+            self.transition(movement, driver, {"$set": {"State": "applied"}})
+        self.record(movement)
+        for entry in movement["Entries"]:
+            collection, selection = self.account(entry)
+            collection.update_one(selection, {"$pull": {"Pending": movement["_id"]}})
+        self.finish(movement, driver, "done")
+
+    def finish(self, movement, driver, state):
+        """
+            Marks a movement done or cancelled. A cancelled movement moved no money, it
+            releases its idempotency claim so the request can run again
+        """
+        update = {"$set": {
+            "State": state,
+            "DoneAt": datetime.datetime.utcnow()
+        }}
+        if state == "cancelled":
+            update["$unset"] = {"IdempotencyKey": ""}
+        self.transition(movement, driver, update)
+
+    def movementOf(self, key):
+        """
+            Returns the movement journaled for an idempotency claim and not cancelled, or None
+        """
+        return self.journal.find_one({"IdempotencyKey": key}, {"State": 1, "Type": 1})
+
+    def maybeRecover(self):
+        """
+            Runs recover() every recoverAfter seconds, on one thread at a time
+        """
+        if time.monotonic() - self.lastRecover < self.recoverAfter:
+            return
+        if not self.recovering.acquire(blocking=False):
+            return
+        try:
+            self.lastRecover = time.monotonic()
+            self.recover()
+        finally:
+            self.recovering.release()
+
+    def claim(self, movement):
+        """
+            Takes a movement over from its driver, in a single conditional update. Return
+            the movement and the new driver, or None if another worker changed it first
+        """
+        driver = self.lease()
+        now = datetime.datetime.utcnow()
+        claimed = self.journal.find_one_and_update(
+            {"_id": movement["_id"], "State": movement["State"], "Driver": movement.get("Driver")},
+            {"$set": {"Driver": driver["Id"], "ClaimedAt": now, "RecoveredAt": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        return None if claimed is None else (claimed, driver)
+
+    def recover(self):
+        """
+            Finishes the movements still unfinished recoverAfter seconds after their last
+            claim. A pending movement whose first account was charged is applied to the
+            rest of the accounts, otherwise it's cancelled. A movement that fails with a
+            LedgerError, e.g. for an account that no longer exists, is marked failed and
+            logged instead of failing the request that runs the recovery. Return the
+            number of movements recovered
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.recoverAfter)
+        recovered = 0
+        # Movements journaled before drivers existed have no ClaimedAt
+        unfinished = self.journal.find({"State": {"$in": ["pending", "applied"]}, "$or": [
+            {"ClaimedAt": {"$lt": cutoff}},
+            {"ClaimedAt": {"$exists": False}, "CreatedAt": {"$lt": cutoff}}
+        ]})
+        for movement in unfinished:
+            claimed = self.claim(movement)
+            if claimed is None:
+                continue
+            movement, driver = claimed
+            try:
+                self.drive(movement, driver)
+            except LeaseExpired as e:
+                logger.warning("Recovery of movement %s stopped: %s", movement["_id"], e)
+                continue
+            except LedgerError as e:
+                logger.error("Movement %s can't be recovered: %s", movement["_id"], e)
+                self.journal.update_one({"_id": movement["_id"], "Driver": driver["Id"]},
+                                        {"$set": {"State": "failed", "Error": str(e)}})
+                continue
+            recovered += 1
+        return recovered
+
+    def drive(self, movement, driver):
+        """
+            Finishes a claimed movement from the State it's in
+        """
+        if movement["State"] == "pending":
+            collection, selection = self.account(movement["Entries"][0])
+            if collection.find_one(dict(selection, Pending=movement["_id"]), {"_id": 1}) is None:
+                self.finish(movement, driver, "cancelled")
+                return
+            self.apply(movement, driver)
+        self.commit(movement, driver)
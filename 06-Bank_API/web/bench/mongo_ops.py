@@ -0,0 +1,68 @@
+"""
+    Counts the MongoDB commands each endpoint of the Bank API sends, from the
+    mongoOps counter of /metrics. Start the API with docker-compose up, then:
+
+        docker-compose exec web python bench/mongo_ops.py
+
+    The API must be the only client and run a single worker, every command
+    sent between two reads of /metrics is charged to the call in between.
+    Each call is repeated and the lowest count kept, so a revocation sync or
+    a ledger recovery running at the same time doesn't skew it
+"""
+
+import argparse
+import json
+import secrets
+import urllib.request
+
+
+def call(base, method, path, body=None):
+    data = None if body is None else json.dumps(body).encode('utf8')
+    request = urllib.request.Request(base + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+def mongoOps(base):
+    return call(base, "GET", "/metrics")["mongoOps"]
+
+def countOps(base, path, body, repeat):
+    """
+        Lowest number of MongoDB commands of a POST to path over repeat calls
+    """
+    counts = []
+    for _ in range(repeat):
+        before = mongoOps(base)
+        call(base, "POST", path, body)
+        counts.append(mongoOps(base) - before)
+    return min(counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    suffix = secrets.token_hex(4)
+    alice, bob = f"ops-alice-{suffix}", f"ops-bob-{suffix}"
+    for username in (alice, bob):
+        call(args.url, "POST", "/register", {"username": username, "password": "pw"})
+    call(args.url, "POST", "/add", {"username": alice, "password": "pw", "amount": 1000000})
+
+    calls = [
+        ("/balanceCheck", "", {"username": alice, "password": "pw"}),
+        ("/add", "", {"username": alice, "password": "pw", "amount": 10}),
+        ("/transfer", "", {"username": alice, "password": "pw", "to": bob, "amount": 10}),
+        ("/transfer", "not enough money", {"username": alice, "password": "pw", "to": bob, "amount": 10 ** 12}),
+        ("/takeLoan", "", {"username": alice, "password": "pw", "amount": 10}),
+        ("/payLoan", "", {"username": alice, "password": "pw", "amount": 10}),
+        ("/statement", "10 transactions", {"username": alice, "password": "pw", "limit": 10}),
+    ]
+
+    print(f"{'endpoint':<16}{'case':<20}{'mongo ops':>10}")
+    for path, case, body in calls:
+        print(f"{path:<16}{case:<20}{countOps(args.url, path, body, args.repeat):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+    Throughput of password checks from concurrent clients: bcrypt in the
+    calling thread as the API first did, bcrypt on the crypto pool, and
+    checkPassword, which answers repeated credentials from the credential
+    cache. Runs in the web container, or anywhere with bcrypt installed:
+
+        docker-compose exec web python bench/password_checks.py
+
+    The pool size comes from CRYPTO_WORKERS, as in the API
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import bcrypt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import checkPassword, credentialCache, cryptoExecutor
+
+
+def throughput(check, clients, seconds):
+    """
+        Calls check from clients threads for seconds. Return the checks per second
+    """
+    counts = [0] * clients
+    deadline = time.monotonic() + seconds
+
+    def client(n):
+        while time.monotonic() < deadline:
+            if not check():
+                raise RuntimeError("The password check failed")
+            counts[n] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=cryptoExecutor.workers)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    cryptoExecutor.warmUp()
+    password = "bench password"
+    hashed_pw = bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt())
+
+    modes = [
+        ("bcrypt inline", lambda: bcrypt.checkpw(password.encode('utf8'), hashed_pw)),
+        ("bcrypt on the pool", lambda: cryptoExecutor.hashpw(password.encode('utf8'), hashed_pw, "verify") == hashed_pw),
+        ("checkPassword cached", lambda: checkPassword("bench", password, hashed_pw)),
+    ]
+
+    print(f"{args.clients} clients, {cryptoExecutor.workers} crypto workers")
+    print(f"{'mode':<24}{'checks/s':>12}")
+    for name, check in modes:
+        print(f"{name:<24}{throughput(check, args.clients, args.seconds):>12.1f}")
+    print(f"cache                   {credentialCache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+    Concurrent transfer stress test of the Bank API. Funds a set of fresh
+    accounts, fires random transfers between them from many clients at once,
+    some of them bigger than the sender's balance, and checks that no money
+    was created or lost. Start the API with docker-compose up, then:
+
+        docker-compose exec web python bench/stress_transfers.py
+
+    Every deposit and every accepted transfer pays the 1 USD fee to the bank,
+    so the accounts must end with the deposits minus those fees. With
+    --bank-password the fees collected by the BANK are checked as well, the
+    BANK user is registered with that password if it doesn't exist
+"""
+
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+FEE = 1
+
+
+def call(base, path, body):
+    request = urllib.request.Request(base + path, data=json.dumps(body).encode('utf8'),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())
+
+def balance(base, username, password):
+    return call(base, "/balanceCheck", {"username": username, "password": password})["Money"]
+
+def createAccounts(base, count, deposit):
+    """
+        Registers count fresh users and deposits the same amount in each one
+    """
+    suffix = secrets.token_hex(4)
+    accounts = [f"stress-{suffix}-{n}" for n in range(count)]
+    for username in accounts:
+        call(base, "/register", {"username": username, "password": "pw"})
+        call(base, "/add", {"username": username, "password": "pw", "amount": deposit})
+    return accounts
+
+def runTransfers(base, accounts, clients, transfers, maxAmount, seed=0):
+    """
+        Runs transfers random transfers from clients threads. Return the counts of
+        accepted and refused transfers and the seconds it took
+    """
+    counts = {"accepted": 0, "refused": 0, "other": 0}
+    lock = threading.Lock()
+
+    def client(n):
+        rng = random.Random(seed + n)
+        for _ in range(transfers // clients):
+            sender, receiver = rng.sample(accounts, 2)
+            retJson = call(base, "/transfer", {
+                "username": sender,
+                "password": "pw",
+                "to": receiver,
+                "amount": rng.randint(1, maxAmount)
+            })
+            outcome = {200: "accepted", 306: "refused"}.get(retJson["status"], "other")
+            with lock:
+                counts[outcome] += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(client, range(clients)))
+    return counts, time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--deposit", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--transfers", type=int, default=4000)
+    parser.add_argument("--max-amount", type=int, default=200)
+    parser.add_argument("--bank-password")
+    args = parser.parse_args()
+
+    if args.bank_password:
+        call(args.url, "/register", {"username": "BANK", "password": args.bank_password})
+        bankBefore = balance(args.url, "BANK", args.bank_password)
+
+    accounts = createAccounts(args.url, args.accounts, args.deposit)
+    counts, seconds = runTransfers(args.url, accounts, args.clients, args.transfers, args.max_amount)
+
+    total = sum(balance(args.url, username, "pw") for username in accounts)
+    expected = args.accounts * (args.deposit - FEE) - counts["accepted"] * FEE
+
+    print(f"clients              {args.clients}")
+    print(f"transfers            {sum(counts.values())} ({counts['accepted']} accepted, "
+          f"{counts['refused']} refused, {counts['other']} other)")
+    print(f"transfers/second     {sum(counts.values()) / seconds:.1f}")
+    print(f"accounts total       {total} (expected {expected})")
+    ok = total == expected and counts["other"] == 0
+
+    if args.bank_password:
+        fees = balance(args.url, "BANK", args.bank_password) - bankBefore
+        expectedFees = (args.accounts + counts["accepted"]) * FEE
+        print(f"fees collected       {fees} (expected {expectedFees}, exact only without other traffic)")
+        ok = ok and fees == expectedFees
+
+    print("money conserved" if ok else "MONEY NOT CONSERVED")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
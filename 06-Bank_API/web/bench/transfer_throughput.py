@@ -0,0 +1,39 @@
+"""
+    Transfer throughput of the Bank API from many clients. Every accepted
+    transfer credits its fee to one of the FEE_STRIPES fee counters, run it
+    once with the default stripes and once with a single one, the single
+    BANK document every fee used to contend on:
+
+        docker-compose up -d
+        docker-compose exec web python bench/transfer_throughput.py
+        FEE_STRIPES=1 docker-compose up -d
+        docker-compose exec web python bench/transfer_throughput.py
+
+    The accounts are funded well above the transfer amounts so that almost
+    every transfer is accepted and pays its fee
+"""
+
+import argparse
+
+from stress_transfers import createAccounts, runTransfers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--accounts", type=int, default=64)
+    parser.add_argument("--clients", default="1,16,64")
+    parser.add_argument("--transfers", type=int, default=6400, help="transfers per concurrency level")
+    args = parser.parse_args()
+
+    accounts = createAccounts(args.url, args.accounts, 10 ** 9)
+
+    print(f"{'clients':>8}{'transfers/s':>13}{'accepted':>10}{'refused':>9}{'other':>7}")
+    for clients in [int(value) for value in args.clients.split(",")]:
+        counts, seconds = runTransfers(args.url, accounts, clients, args.transfers, 10, seed=clients)
+        total = sum(counts.values())
+        print(f"{clients:>8}{total / seconds:>13.1f}{counts['accepted']:>10}{counts['refused']:>9}{counts['other']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+    Latency of the user lookup every endpoint starts with, find_one by
+    Username, with and without the unique Username index the APIs create
+    at startup. The users are inserted in a scratch database of the compose
+    MongoDB, dropped at the end. Start the stack with docker-compose up,
+    then:
+
+        docker-compose exec web python bench/user_lookups.py
+
+    The users collection grows to each size in turn, every size is
+    measured without the index, then with it
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from pymongo import MongoClient
+
+# The projection of USER_FIELDS in app.py
+FIELDS = {"_id": 0, "Username": 1, "Password": 1, "Money": 1, "Debt": 1}
+
+
+def grow(users, start, end):
+    """
+        Inserts the users numbered start to end - 1, in batches
+    """
+    for first in range(start, end, 10000):
+        users.insert_many([{
+            "Username": f"user{n}",
+            "Password": b"$2b$12$" + b"x" * 53,
+            "Money": 0,
+            "Debt": 0
+        } for n in range(first, min(first + 10000, end))], ordered=False)
+
+def lookups(users, size, queries, rng):
+    """
+        Timed find_one of random existing users. Return the sorted latencies and the
+        documents examined by one of the lookups
+    """
+    seconds = []
+    for _ in range(queries):
+        username = f"user{rng.randrange(size)}"
+        start = time.monotonic()
+        users.find_one({"Username": username}, FIELDS)
+        seconds.append(time.monotonic() - start)
+    plan = users.find({"Username": username}, FIELDS).limit(1).explain()
+    return sorted(seconds), plan["executionStats"]["totalDocsExamined"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", default="mongodb://db:27017")
+    parser.add_argument("--database", default="LookupBench")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo)
+    if args.database in client.list_database_names():
+        raise SystemExit(f"The database {args.database} already exists, pick another one with --database")
+    users = client[args.database]["Users"]
+    rng = random.Random(0)
+
+    print(f"{'users':>9}{'index':>7}{'p50 ms':>9}{'p95 ms':>9}{'docs examined':>15}")
+    try:
+        size = 0
+        for target in [int(value) for value in args.sizes.split(",")]:
+            grow(users, size, target)
+            size = target
+            for indexed in (False, True):
+                if indexed:
+                    users.create_index("Username", unique=True)
+                seconds, examined = lookups(users, size, args.queries, rng)
+                print(f"{size:>9}{'yes' if indexed else 'no':>7}"
+                      f"{statistics.median(seconds) * 1000:>9.2f}"
+                      f"{seconds[int(len(seconds) * 0.95)] * 1000:>9.2f}{examined:>15}")
+            users.drop_index("Username_1")
+    finally:
+        client.drop_database(args.database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+    Idempotency keys: a request sent with an Idempotency-Key header runs once,
+    its retries get the response of the first run
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo.errors import DuplicateKeyError
+
+# Responses are replayed for IDEMPOTENCY_TTL seconds, the last
+# IDEMPOTENCY_CACHE_SIZE of them straight from memory. A request that hasn't
+# finished IDEMPOTENCY_LEASE seconds after it started is presumed dead
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_LEASE = int(os.environ.get("IDEMPOTENCY_LEASE", 60))
+
+
+class IdempotencyKeys:
+    """
+        Stores the response of every request with an Idempotency-Key in the keys
+        collection, until MongoDB expires it after ttl seconds. A key belongs to
+        a user and to the body of its first request: a retry gets the stored
+        response without running again, a different request with the same key
+        is refused. Finished responses are also kept in a small in-memory cache,
+        so hot retries hitting the same worker need no MongoDB round trip.
+
+        Every claim has a random Claim id, the movement of the request is
+        journaled by the ledger under it. A claim still started leaseSeconds
+        after it started belongs to a dead worker: the journal tells whether
+        its money moved, and if it didn't, a retry takes the claim over
+    """
+    def __init__(self, keys, ledger, ttlSeconds=IDEMPOTENCY_TTL, maxEntries=IDEMPOTENCY_CACHE_SIZE,
+                 leaseSeconds=IDEMPOTENCY_LEASE):
+        self.keys = keys
+        self.ledger = ledger
+        self.ttl = ttlSeconds
+        self.maxEntries = maxEntries
+        self.lease = leaseSeconds
+        self.lock = threading.Lock()
+        self.responses = OrderedDict()
+
+    def createIndexes(self):
+        self.keys.create_index("CreatedAt", expireAfterSeconds=self.ttl)
+
+    def fingerprint(self, postedData):
+        """
+            Hash of the request body, without the password
+        """
+        body = {field: value for field, value in postedData.items() if field != "password"}
+        return hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf8')).hexdigest()
+
+    def cached(self, keyId):
+        with self.lock:
+            entry = self.responses.get(keyId)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                del self.responses[keyId]
+                return None
+            self.responses.move_to_end(keyId)
+            return entry
+
+    def remember(self, keyId, fingerprint, retJson):
+        with self.lock:
+            self.responses[keyId] = (fingerprint, retJson, time.monotonic() + self.ttl)
+            self.responses.move_to_end(keyId)
+            while len(self.responses) > self.maxEntries:
+                self.responses.popitem(last=False)
+
+    def replay(self, fingerprint, storedFingerprint, retJson):
+        if storedFingerprint != fingerprint:
+            return {
+                "status": 308,
+                "msg": "This Idempotency-Key was already used for a different request"
+            }
+        return retJson
+
+    def inProgress(self):
+        return {
+            "status": 309,
+            "msg": "A request with this Idempotency-Key is still in progress, retry later"
+        }
+
+    def begin(self, username, key, postedData):
+        """
+            Claims a key for the current request. Return (None, claim) if the request must
+            run, its movement goes to the ledger with the claim id. Otherwise return the
+            JSON to answer with and None: the stored response of a retry, or an error if
+            the key is in use by another request
+        """
+        keyId = f"{username}:{key}"
+        fingerprint = self.fingerprint(postedData)
+
+        entry = self.cached(keyId)
+        if entry is not None:
+            return self.replay(fingerprint, entry[0], entry[1]), None
+
+        now = datetime.datetime.utcnow()
+        claim = secrets.token_hex(16)
+        try:
+            self.keys.insert_one({
+                "_id": keyId,
+                "Fingerprint": fingerprint,
+                "State": "started",
+                "Claim": claim,
+                "StartedAt": now,
+                "CreatedAt": now
+            })
+            return None, claim
+        except DuplicateKeyError:
+            stored = self.keys.find_one({"_id": keyId})
+
+        # The key expired between the insert and the read
+        if stored is None:
+            return self.begin(username, key, postedData)
+
+        if stored["State"] != "done":
+            if stored["Fingerprint"] != fingerprint:
+                return self.replay(fingerprint, stored["Fingerprint"], None), None
+            if stored["StartedAt"] > now - datetime.timedelta(seconds=self.lease):
+                return self.inProgress(), None
+            return self.reclaim(keyId, stored)
+
+        self.remember(keyId, stored["Fingerprint"], stored["Response"])
+        return self.replay(fingerprint, stored["Fingerprint"], stored["Response"]), None
+
+    def reclaim(self, keyId, stored):
+        """
+            Settles the claim of a request whose lease expired, from the journal. If its
+            movement is done the money moved, the claim is finished with a response that
+            says so. If it's still running the ledger recovers it and the client must
+            retry. If there is none, or it was cancelled, no money moved and the current
+            request takes the claim over. The movement keeps the claim id, so even if the
+            first request is only slow the journal accepts a single movement
+        """
+        movement = self.ledger.movementOf(stored["Claim"])
+        if movement is not None and movement["State"] == "done":
+            retJson = {
+                "status": 200,
+                "msg": f"The {movement['Type']} of this Idempotency-Key was completed"
+            }
+            self.keys.update_one({"_id": keyId}, {"$set": {"State": "done", "Response": retJson}})
+            self.remember(keyId, stored["Fingerprint"], retJson)
+            return retJson, None
+
+        if movement is not None:
+            self.ledger.maybeRecover()
+            return self.inProgress(), None
+
+        # Of several retries only the first one takes the claim
+        taken = self.keys.update_one(
+            {"_id": keyId, "State": "started", "StartedAt": stored["StartedAt"]},
+            {"$set": {"StartedAt": datetime.datetime.utcnow()}}
+        )
+        if taken.modified_count == 0:
+            return self.inProgress(), None
+        return None, stored["Claim"]
+
+    def finish(self, username, key, postedData, retJson):
+        """
+            Stores the response of a request that claimed a key
+        """
+        keyId = f"{username}:{key}"
+        self.keys.update_one({"_id": keyId}, {"$set": {"State": "done", "Response": retJson}})
+        self.remember(keyId, self.fingerprint(postedData), retJson)
+
+    def abandon(self, username, key, claim):
+        """
+            Frees the key of a request that failed, so it can be retried. A request that
+            failed after journaling its movement keeps the key, its lease expires and
+            the journal settles it
+        """
+        if self.ledger.movementOf(claim) is None:
+            self.keys.delete_one({"_id": f"{username}:{key}", "State": "started", "Claim": claim})
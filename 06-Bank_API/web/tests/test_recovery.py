@@ -0,0 +1,109 @@
+"""
+    Tests of the recovery of unfinished movements by BankLedger. They use a
+    scratch database of the MongoDB of docker-compose, run them in the web
+    container:
+
+        docker-compose exec web python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bank_ledger import BankLedger, FeeCounter, LeaseExpired
+
+TEST_DATABASE = "BankLedgerTest"
+
+# recover() only claims movements this many seconds after their last claim
+RECOVER_AFTER = 1
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.client = MongoClient(os.environ.get("MONGO_URL", "mongodb://db:27017"))
+        self.client.drop_database(TEST_DATABASE)
+        db = self.client[TEST_DATABASE]
+        self.users = db["Users"]
+        self.ledger = self.newLedger(recoverAfter=60)
+        self.ledger.createIndexes()
+        for username in ("alice", "bob"):
+            self.users.insert_one({"Username": username, "Money": 100, "Debt": 0})
+
+    def tearDown(self):
+        self.client.drop_database(TEST_DATABASE)
+
+    def newLedger(self, recoverAfter):
+        """
+            Another worker on the same collections
+        """
+        db = self.client[TEST_DATABASE]
+        return BankLedger(self.users, db["Journal"], db["Transactions"], FeeCounter(db["Fees"], stripes=1),
+                          recoverAfter=recoverAfter)
+
+    def money(self, username):
+        return self.users.find_one({"Username": username})["Money"]
+
+    def stall(self, entries):
+        """
+            Journals a transfer of 10 from alice to bob and applies only its first entry,
+            as a worker that stopped there. Return the movement and its driver
+        """
+        self.ledger.maybeRecover = lambda: None
+        apply = self.ledger.apply
+        stalled = {}
+
+        def applyFirst(movement, driver):
+            self.ledger.applyEntry(movement["_id"], movement["Entries"][0])
+            stalled.update(movement=movement, driver=driver)
+            raise RuntimeError("stalled")
+
+        self.ledger.apply = applyFirst
+        with self.assertRaises(RuntimeError):
+            self.ledger.move("transfer", entries)
+        self.ledger.apply = apply
+        time.sleep(RECOVER_AFTER * 1.1)
+        return stalled["movement"], stalled["driver"]
+
+    def transferEntries(self, receiver="bob"):
+        return [
+            ({"Username": "alice"}, {"Money": -10}, {"Money": 10}),
+            ({"Username": receiver}, {"Money": 10}, None)
+        ]
+
+    def test_recovery_finishes_a_stalled_movement_once(self):
+        self.stall(self.transferEntries())
+        first = self.newLedger(recoverAfter=RECOVER_AFTER)
+        second = self.newLedger(recoverAfter=RECOVER_AFTER)
+        self.assertEqual(first.recover(), 1)
+        self.assertEqual(second.recover(), 0)
+        self.assertEqual((self.money("alice"), self.money("bob")), (90, 110))
+
+    def test_stalled_driver_stops_after_recovery_claims(self):
+        movement, driver = self.stall(self.transferEntries())
+        self.newLedger(recoverAfter=RECOVER_AFTER).recover()
+
+        # The first worker resumes: its lease ran out and the journal has another driver
+        driver["Until"] = 0
+        with self.assertRaises(LeaseExpired):
+            self.ledger.apply(movement, driver)
+        driver["Until"] = float("inf")
+        with self.assertRaises(LeaseExpired):
+            self.ledger.commit(movement, driver)
+        self.assertEqual((self.money("alice"), self.money("bob")), (90, 110))
+
+    def test_unrecoverable_movement_is_marked_failed(self):
+        movement, _ = self.stall(self.transferEntries(receiver="nobody"))
+        recovering = self.newLedger(recoverAfter=RECOVER_AFTER)
+        recovering.lastRecover = 0
+        recovering.maybeRecover()
+        self.assertEqual(recovering.journal.find_one({"_id": movement["_id"]})["State"], "failed")
+        self.assertEqual(recovering.recover(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()